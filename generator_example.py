@@ -1,7 +1,19 @@
+import os
+import sys
+import json
 import random
+import argparse
+import functools
+import itertools
 import collections
 import time
-from typing import Literal, List, Set, Tuple, Callable
+import types
+import multiprocessing
+import concurrent.futures
+from typing import Literal, List, Mapping, Union, Tuple, Callable, Iterable
+
+from solver_example import (RelationKind, Same, Offset, Compare, At, Parity, SameParity, Between, Or, Xor, Budget,
+                            Propagator, backtrack, count_value_degrees, undo)
 
 
 def format_table(header: List[str], table: List[List[str]],
@@ -20,161 +32,274 @@ def format_table(header: List[str], table: List[List[str]],
                for row_format, row in zip(table_format, table))
 
 
-def update_range(wns: List[str], rns: List[List[Set[str]]], cmp: Callable):
-    changed = False
-    for rn in rns:
-        classified_words = set()
-        for n_col, set_of_words in enumerate(rn):
-            if len(set_of_words) == 1:
-                classified_words.add(next(iter(set_of_words)))
-        word_to_cols = dict()
-        for n_col, set_of_words in enumerate(rn):
-            if len(set_of_words) != 1:
-                prev_length = len(set_of_words)
-                set_of_words.difference_update(classified_words)
-                changed |= prev_length != len(set_of_words)
-                for word in set_of_words:
-                    word_to_cols.setdefault(word, set()).add(n_col)
-        for word, cols in word_to_cols.items():
-            if len(cols) == 1:
-                x = rn[next(iter(cols))]
-                if len(x) != 1:
-                    x.clear()
-                    x.add(word)
-                    changed = True
-
-    new_rns = [[{x for x in xs if x != wn} for xs in rn] for wn, rn in zip(wns, rns)]
-    pairs = []
-    for wn, rn in zip(wns, rns):
-        new_pairs = []
-        break_condition = True
-        for cn, setn in enumerate(rn):
-            if wn in setn:
-                break_condition = False
-                if not pairs:
-                    pairs = [[]]
-                for v in pairs:
-                    new_pairs.append([*v, cn])
-        pairs = new_pairs
-        if break_condition:
-            break
-    for pair in pairs:
-        if cmp(*pair):
-            for nrn, cn, wn in zip(new_rns, pair, wns):
-                nrn[cn].add(wn)
-    changed |= any(rn != new_rn for rn, new_rn in zip(rns, new_rns))
-    if changed:
-        for rn, new_rn in zip(rns, new_rns):
-            for old, new in zip(rn, new_rn):
-                old.intersection_update(new)
-    return changed
-
-
-def update_ranges(relations: List[Tuple[List[int], List[str], Callable, ...]],
-                  ranges: List[List[Set[str]]]):
-    changed = False
-    for ins, wns, callable_object, *_ in relations:
-        changed |= update_range(wns, [ranges[i] for i in ins], callable_object)
-    return changed
+class UnresolvedCells:
+    """Cells (row, position) that more than one value of the row can still take.
 
+    The index is kept up to date from the masks that propagation overwrote (see `update`) instead of
+    rescanning the grid, `cells` is a list, so a random cell is picked in constant time."""
 
-def generate_puzzle(table: List[List[str]], *,
-                    level: Literal[1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20],
-                    minimal_conditions: bool = False, max_seconds_for_minimizing: float = None,
-                    tries: int = 10):
-    if level not in range(1, 20 + 1):
-        raise ValueError('level must be >= 1 and <= 20')
+    def __init__(self, domains: List[List[int]]):
+        self.rows = {id(row): i for i, row in enumerate(domains)}
+        self.counts = [[sum(1 for mask in row if mask >> j & 1) for j in range(len(row))] for row in domains]
+        self.cells = [(i, j) for i, counts in enumerate(self.counts) for j, count in enumerate(counts) if count > 1]
+        self.index = {cell: k for k, cell in enumerate(self.cells)}
+        self.n_empty = sum(1 for counts in self.counts for count in counts if not count)  # positions without values
 
-    table_wo_left = [row[1:] for row in table]
-    n_attributes = len(table_wo_left)
-    m_objects = len(table_wo_left[0])
+    def update(self, trail: list):
+        """Account for the masks recorded on `trail` (row, value index, old mask) and clear it."""
+        oldest = {}
+        for row, v, mask in trail:
+            oldest.setdefault((id(row), v), (row, v, mask))
+        trail.clear()
+        for row, v, mask in oldest.values():
+            i = self.rows[id(row)]
+            removed = mask & ~row[v]
+            while removed:
+                bit = removed & -removed
+                removed ^= bit
+                j = bit.bit_length() - 1
+                self.counts[i][j] -= 1
+                if self.counts[i][j] <= 1 and (i, j) in self.index:
+                    # swap the cell with the last one and drop it
+                    k = self.index.pop((i, j))
+                    last = self.cells.pop()
+                    if last != (i, j):
+                        self.cells[k] = last
+                        self.index[last] = k
+                if not self.counts[i][j]:
+                    self.n_empty += 1
+
+
+def is_unique_answer(domains: List[List[int]], propagator: Propagator, answer: List[List[int]],
+                     value_degrees: Union[List[List[int]], None] = None, budget: Union[Budget, None] = None) -> bool:
+    """Whether `answer` (the value index at every position of every row, a known solution) is the only
+    solution of propagated `domains`.
+
+    The search tries the values that disagree with the answer first and stops at the first solution: any
+    other solution is found before the answer, and the answer comes first only if no other solution exists.
+    If `budget` is exhausted the result is undecided, check `budget.exhausted`."""
+    solutions = backtrack(domains, propagator, value_degrees, budget=budget, answer=answer)
+    for solved in solutions:
+        unique = all(solved[i][v] == 1 << j for i, row in enumerate(answer) for j, v in enumerate(row))
+        solutions.close()
+        return unique
+    return False
+
+
+def check_unique(relations: List[Tuple[List[int], List[int], RelationKind, ...]], n_attributes: int,
+                 m_objects: int, alldifferent: Literal['singles', 'matching'] = 'singles',
+                 budget: Union[Budget, None] = None) -> bool:
+    """Whether compiled `relations` of a generated grid have no solution but the answer, in which the value
+    index of every word is its column. A check that runs out of `budget` is undecided and returns False."""
+    domains = [[(1 << m_objects) - 1] * m_objects for _ in range(n_attributes)]
+    propagator = Propagator(relations, n_attributes, alldifferent=alldifferent)
+    answer = [list(range(m_objects)) for _ in range(n_attributes)]
+    # the answer always satisfies the relations, so only another solution makes them ambiguous
+    unique = propagator.propagate(domains) and is_unique_answer(
+        domains, propagator, answer, count_value_degrees(relations, domains), budget)
+    return unique and not (budget is not None and budget.exhausted)
+
+
+def first_unique(candidates: Iterable[list], is_unique: Callable[[list], bool],
+                 deadline: Union[float, None] = None) -> Union[int, None]:
+    """The index of the first of `candidates` (relation lists) for which `is_unique` holds, None if there is
+    none or `deadline` of `time.monotonic()` is reached first."""
+    for k, relations in enumerate(candidates):
+        if deadline is not None and time.monotonic() >= deadline:
+            return None
+        if is_unique(relations):
+            return k
+    return None
+
+
+_generation = None  # the round counter of a `UniquenessPool`, a worker stops a check of an older round
+
+
+def _init_worker(generation):
+    global _generation
+    _generation = generation
+
+
+def _check_unique_in_worker(relations, n_attributes, m_objects, alldifferent, max_seconds, max_nodes, generation):
+    """`check_unique` in a pool worker, stopped once the pool has moved on from `generation`."""
+    budget = Budget(max_seconds, max_nodes, cancel=lambda: _generation.value != generation)
+    return check_unique(relations, n_attributes, m_objects, alldifferent, budget)
 
-    if level >= 19 and m_objects == 2:
-        raise ValueError('too few objects for level >= 19')
-    elif m_objects <= 1:
-        raise ValueError('m_objects must be >= 2')
-    elif n_attributes <= 0:
-        raise ValueError('n_attributes must be >= 1')
 
+class UniquenessPool:
+    """`workers` processes that check removal candidates of the minimization at the same time.
+
+    `first_unique` keeps every worker busy with the next candidates and returns as soon as the first unique
+    candidate is known, that is, when all candidates before it are known to be ambiguous, so the result is
+    the same as checking them one by one. The checks after it are stale then: pending ones are cancelled and
+    running ones stop at their next node."""
+
+    def __init__(self, workers: int, n_attributes: int, m_objects: int,
+                 alldifferent: Literal['singles', 'matching'] = 'singles',
+                 max_seconds_per_check: float = None, max_nodes_per_check: int = None):
+        context = multiprocessing.get_context()
+        self.workers = workers
+        self.generation = context.Value('i', 0)
+        self.executor = concurrent.futures.ProcessPoolExecutor(workers, mp_context=context,
+                                                               initializer=_init_worker, initargs=(self.generation,))
+        self.check_args = (n_attributes, m_objects, alldifferent, max_seconds_per_check, max_nodes_per_check)
+
+    def first_unique(self, candidates: Iterable[list], deadline: Union[float, None] = None) -> Union[int, None]:
+        """Like `first_unique`, with the checks spread over the workers."""
+        candidates = iter(candidates)
+        generation = self.generation.value
+        futures = []
+        submitted_all = False
+        try:
+            while True:
+                # keep one check per worker running
+                while not submitted_all and sum(1 for future in futures if not future.done()) < self.workers:
+                    relations = next(candidates, None)
+                    if relations is None:
+                        submitted_all = True
+                        break
+                    futures.append(self.executor.submit(_check_unique_in_worker, relations, *self.check_args,
+                                                        generation))
+                for k, future in enumerate(futures):
+                    if not future.done():
+                        break
+                    if future.result():
+                        return k
+                else:
+                    # every check so far is ambiguous, the rest of the candidates decide
+                    if submitted_all:
+                        return None
+                    continue
+                timeout = None if deadline is None else deadline - time.monotonic()
+                if timeout is not None and timeout <= 0:
+                    return None
+                concurrent.futures.wait([future for future in futures if not future.done()], timeout=timeout,
+                                        return_when=concurrent.futures.FIRST_COMPLETED)
+        finally:
+            with self.generation.get_lock():
+                self.generation.value += 1
+            for future in futures:
+                future.cancel()
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+def minimize_relations(relations: list, is_unique: Callable[[list], bool], deadline: Union[float, None] = None,
+                       one_by_one: bool = False, pool: Union[UniquenessPool, None] = None) -> Tuple[list, bool]:
+    """Remove relations while `is_unique` holds for the rest, returns (relations, whether `deadline` of
+    `time.monotonic()` was reached first).
+
+    Like delta debugging, relations are removed in chunks: a chunk is dropped if the rest is still unique and
+    kept otherwise, then the chunk size is halved (`one_by_one` starts with single relations). The last pass
+    tries every single relation, and a relation that is needed stays needed when others are removed, so no
+    single relation of the result can be removed. With `pool` the candidates of a pass are checked by its
+    workers at the same time, the result does not change."""
+    chunk = 1 if one_by_one else max(len(relations) // 2, 1)
+    while True:
+        k = 0
+        while k < len(relations):
+            starts = range(k, len(relations), chunk)
+            candidates = (relations[:start] + relations[start + chunk:] for start in starts)
+            if pool is not None:
+                found = pool.first_unique(candidates, deadline)
+            else:
+                found = first_unique(candidates, is_unique, deadline)
+            if found is None:
+                if deadline is not None and time.monotonic() >= deadline:
+                    return relations, True
+                break
+            k = starts[found]
+            relations = relations[:k] + relations[k + chunk:]
+        if chunk == 1:
+            return relations, False
+        chunk //= 2
+
+
+@functools.lru_cache(maxsize=None)
+def rule_catalog(level: int, m_objects: int) -> Mapping[Tuple[int, ...], tuple]:
+    """The relation rules of `level` for `m_objects` objects, compiled once: a read-only mapping from a tuple
+    of positions to the rules (kind, format strings, arguments must be in different rows) that hold for it,
+    so candidate relations are looked up by the positions of their cells."""
     center = m_objects // 2
     except_flag = True
     rules_for_relations = [
-        (2, lambda j1, j2: j1 == j2, ['{0}:{1} == {2}:{3}', '{2}:{3} == {0}:{1}']),
-        (2, lambda j1, j2: j1 == j2 - 1, ['{0}:{1} is on the left of {2}:{3}']),
-        (2, lambda j1, j2: j1 == j2 + 1, ['{0}:{1} is on the right of {2}:{3}']),
-        (1, lambda j1: j1 == 0, ['{0}:{1} is on the far left']),
-        (1, lambda j1, last_index=m_objects - 1: j1 == last_index, ['{0}:{1} is on the far right']),
-    ] + (m_objects % 2 != 0) * [(1, lambda j1, mid=center: j1 == mid, ['{0}:{1} is in the middle'])]
+        (2, Same(), ['{0}:{1} == {2}:{3}', '{2}:{3} == {0}:{1}']),
+        (2, Offset((-1,)), ['{0}:{1} is on the left of {2}:{3}']),
+        (2, Offset((1,)), ['{0}:{1} is on the right of {2}:{3}']),
+        (1, At(frozenset({0})), ['{0}:{1} is on the far left']),
+        (1, At(frozenset({m_objects - 1})), ['{0}:{1} is on the far right']),
+    ] + (m_objects % 2 != 0) * [(1, At(frozenset({center})), ['{0}:{1} is in the middle'])]
     if level >= 2:
         rules_for_relations += [
-            (3, lambda j1, j2, j3: j2 + 1 == j1 == j3 - 1 or j3 + 1 == j1 == j2 - 1,
+            (3, Between(adjacent=True),
              ['{0}:{1} is between {2}:{3} and {4}:{5}', '{0}:{1} is between {4}:{5} and {2}:{3}']),
         ]
     if level >= 3:
         rules_for_relations += [
-            (2, lambda j1, j2: j1 == j2 - 1 or j1 == j2 + 1,
+            (2, Offset((-1, 1)),
              ['{0}:{1} is on the left or right of {2}:{3}']),
-            (1, lambda j1, last_index=m_objects - 1: j1 == 0 or j1 == last_index,
+            (1, At(frozenset({0, m_objects - 1})),
              ['{0}:{1} is on the far left or far right']),
         ]
     if level >= 4:
         rules_for_relations += [
-            (1, lambda j1: (j1 + 1) % 2 != 0, ['{0}:{1} is in an odd position']),
-            (1, lambda j1: (j1 + 1) % 2 == 0, ['{0}:{1} is in an even position']),
+            (1, Parity(0), ['{0}:{1} is in an odd position']),
+            (1, Parity(1), ['{0}:{1} is in an even position']),
         ]
     if level >= 5:
         rules_for_relations += [
-            (2, lambda j1, j2: j1 < j2, ['{0}:{1} is somewhere to the left of {2}:{3}']),
-            (2, lambda j1, j2: j1 > j2, ['{0}:{1} is somewhere to the right of {2}:{3}']),
+            (2, Compare('<'), ['{0}:{1} is somewhere to the left of {2}:{3}']),
+            (2, Compare('>'), ['{0}:{1} is somewhere to the right of {2}:{3}']),
         ]
     if level >= 6:
         rules_for_relations += [
-            (2, lambda j1, j2: j1 != j2, ['{0}:{1} != {2}:{3}', '{2}:{3} != {0}:{1}'], except_flag),
+            (2, Compare('!='), ['{0}:{1} != {2}:{3}', '{2}:{3} != {0}:{1}'], except_flag),
         ]
     if level >= 7:
         rules_for_relations += [
-            (3, lambda j1, j2, j3: j2 < j1 < j3 or j3 < j1 < j2,
+            (3, Between(adjacent=False),
              ['{0}:{1} is somewhere between {2}:{3} and {4}:{5}',
               '{0}:{1} is somewhere between {4}:{5} and {2}:{3}']),
         ]
     if level >= 8:
         rules_for_relations += [
-            (2, lambda j1, j2: j1 >= j2, ['{0}:{1} is not to the left of {2}:{3}']),
-            (2, lambda j1, j2: j1 <= j2, ['{0}:{1} is not to the right of {2}:{3}']),
+            (2, Compare('>='), ['{0}:{1} is not to the left of {2}:{3}']),
+            (2, Compare('<='), ['{0}:{1} is not to the right of {2}:{3}']),
         ]
     if level >= 9:
         rules_for_relations += [
-            (2, lambda j1, j2: j1 % 2 != j2 % 2,
+            (2, SameParity(False),
              ['{0}:{1} and {2}:{3} have different parity positions',
               '{2}:{3} and {0}:{1} have different parity positions'], except_flag),
-            (2, lambda j1, j2: j1 % 2 == j2 % 2,
+            (2, SameParity(True),
              ['{0}:{1} and {2}:{3} have the same parity positions',
               '{2}:{3} and {0}:{1} have the same parity positions'], except_flag),
         ]
     if level >= 10:
         rules_for_relations += [
-            (3, lambda j1, j2, j3: (j1 == j2 and j1 != j3) or (j1 != j2 and j1 == j3),
+            (3, Xor(((Same(), (0, 1)), (Same(), (0, 2)))),
              ['{0}:{1} == {2}:{3} or {0}:{1} == {4}:{5}, but not both',
               '{0}:{1} == {4}:{5} or {0}:{1} == {2}:{3}, but not both'], except_flag),
-            (3, lambda j1, j2, j3: (j1 == j2 and j2 != j3) or (j1 != j2 and j2 == j3),
+            (3, Xor(((Same(), (0, 1)), (Same(), (1, 2)))),
              ['{0}:{1} == {2}:{3} or {2}:{3} == {4}:{5}, but not both',
               '{2}:{3} == {4}:{5} or {0}:{1} == {2}:{3}, but not both'], except_flag),
         ]
     if level >= 11:
         rules_for_relations += [
-            (3, lambda j1, j2, j3: j1 == j2 or j1 == j3,
+            (3, Or(((Same(), (0, 1)), (Same(), (0, 2)))),
              ['{0}:{1} == {2}:{3} or {0}:{1} == {4}:{5} or both',
               '{0}:{1} == {4}:{5} or {0}:{1} == {2}:{3} or both'], except_flag),
-            (3, lambda j1, j2, j3: j1 == j2 or j2 == j3,
+            (3, Or(((Same(), (0, 1)), (Same(), (1, 2)))),
              ['{0}:{1} == {2}:{3} or {2}:{3} == {4}:{5} or both',
               '{2}:{3} == {4}:{5} or {0}:{1} == {2}:{3} or both'], except_flag),
         ]
     if level >= 12:
         rules_for_relations += [
-            (3, lambda j1, j2, j3: j1 != j2 or j1 != j3,
+            (3, Or(((Compare('!='), (0, 1)), (Compare('!='), (0, 2)))),
              ['{0}:{1} != {2}:{3} or {0}:{1} != {4}:{5} or both',
               '{0}:{1} != {4}:{5} or {0}:{1} != {2}:{3} or both'], except_flag),
-            (3, lambda j1, j2, j3: j1 != j2 or j2 != j3,
+            (3, Or(((Compare('!='), (0, 1)), (Compare('!='), (1, 2)))),
              ['{0}:{1} != {2}:{3} or {2}:{3} != {4}:{5} or both',
               '{2}:{3} != {4}:{5} or {0}:{1} != {2}:{3} or both'], except_flag),
         ]
@@ -201,118 +326,55 @@ def generate_puzzle(table: List[List[str]], *,
         rules_for_relations.pop(0)  # pop 'is somewhere to the right of'
     if level >= 20:
         rules_for_relations.pop(0)  # pop '!='
-    is_minimized = False
-    time_elapsed = False
-    min_relations = None
+
+    catalog = collections.defaultdict(list)
+    for n_args, kind, str_variants, *flags in rules_for_relations:
+        for positions in itertools.product(range(m_objects), repeat=n_args):
+            if kind(*positions):
+                catalog[positions].append((kind, tuple(str_variants), bool(flags and flags[0])))
+    return types.MappingProxyType({positions: tuple(rules) for positions, rules in catalog.items()})
+
+
+def build_relations(table: List[List[str]], level: int,
+                    alldifferent: Literal['singles', 'matching'] = 'singles', rng: random.Random = random,
+                    give_up: Union[Callable[[int], bool], None] = None, lookahead: int = 0) -> Union[list, None]:
+    """One try of `generate_puzzle`: relations between random unresolved cells and their neighbours are added
+    until the answer is the only solution left, a try that runs into a contradiction starts over. The
+    candidate relations come from `rule_catalog(level, m_objects)`. Returns the relations, or None as soon
+    as `give_up(number of relations)` is True for an unsolved grid.
+
+    With `lookahead` > 0, up to that many random candidate relations are propagated on trial and one of them
+    is drawn with a probability proportional to the number of candidates it removes, so relations that
+    prune nothing are rarely chosen."""
+    table_wo_left = [row[1:] for row in table]
+    n_attributes = len(table_wo_left)
+    m_objects = len(table_wo_left[0])
+    catalog = rule_catalog(level, m_objects)
+    full_mask = (1 << m_objects) - 1
     while True:
-        ranges = [[set(table_wo_left[i]) for _ in range(len(table_wo_left[i]))] for i in range(len(table_wo_left))]
+        domains = [[full_mask] * m_objects for _ in range(n_attributes)]
         relations = list()
-        fail = False
-        while not fail:
-            needs_clarification = list()
-            no_solutions = False
-            solved = True
-            for i, rng in enumerate(ranges):
-                for j, rs in enumerate(rng):
-                    if len(rs) == 0:
-                        no_solutions = True
-                        solved = False
-                        break
-                    elif len(rs) > 1:
-                        solved = False
-                        needs_clarification.append((i, j))
-                if no_solutions:
-                    break
-            if solved or min_relations is not None and len(relations) >= len(min_relations):
-                tries -= 1
-                if min_relations is None or len(relations) < len(min_relations):
-                    min_relations = relations
-                if tries > 0:
-                    fail = True
-                    continue
-            if tries <= 0:
-                relations = min_relations
-                if not minimal_conditions:
-                    break
-                number_of_relations_min = len(relations)
-                number_of_relations_before = len(relations)
-                start_time = time.monotonic()
-                main_q = collections.deque([relations])
-                while main_q:
-                    current_relations = main_q.popleft()
-                    for k in range(len(current_relations)):
-                        new_ranges = [[set(table_wo_left[i]) for _ in range(len(table_wo_left[i]))]
-                                      for i in range(len(table_wo_left))]
-                        new_relations = current_relations.copy()
-                        new_relations.pop(k)
-                        changed = True
-                        while changed:
-                            changed = update_ranges(new_relations, new_ranges)
-
-                        q = collections.deque([new_ranges])
-                        possible_solutions = []
-                        while q:
-                            current_ranges = q.popleft()
-
-                            no_solutions = False
-                            solved = True
-                            for rng in current_ranges:
-                                for rs in rng:
-                                    if len(rs) == 0:
-                                        no_solutions = True
-                                        solved = False
-                                        break
-                                    elif len(rs) > 1:
-                                        solved = False
-                                if no_solutions or not solved:
-                                    break
-                            if no_solutions:
-                                continue
-                            if solved:
-                                if current_ranges not in possible_solutions:
-                                    possible_solutions.append(current_ranges)
-                                    if len(possible_solutions) >= 2:
-                                        break
-                                continue
-
-                            for n_group, rng in enumerate(current_ranges):
-                                founded = False
-                                for n_x, rs in enumerate(rng):
-                                    if len(rs) > 1:
-                                        founded = True
-                                        for r in rs:
-                                            new_ranges = [[x.copy() for x in row] for row in current_ranges]
-                                            new_ranges[n_group][n_x] = {r}
-                                            changed = True
-                                            while changed:
-                                                changed = update_ranges(new_relations, new_ranges)
-                                            q.appendleft(new_ranges)
-                                        break
-                                if founded:
-                                    break
-                        if len(possible_solutions) == 1:
-                            number_of_relations_after = len(new_relations)
-                            if number_of_relations_min > number_of_relations_after:
-                                number_of_relations_min = number_of_relations_after
-                                relations = new_relations
-                                main_q.append(new_relations)
-                        if max_seconds_for_minimizing is not None and \
-                                time.monotonic() >= start_time + max_seconds_for_minimizing:
-                            time_elapsed = True
-                            break
-                    if time_elapsed:
-                        break
-                is_minimized = number_of_relations_min < number_of_relations_before or not time_elapsed
+        # every new relation is propagated on its own, unresolved cells are updated from the trail
+        propagator = Propagator(relations, n_attributes, alldifferent=alldifferent)
+        unresolved = UnresolvedCells(domains)
+        trail = []
+        consistent = True
+        while True:
+            needs_clarification = unresolved.cells
+            if not consistent or unresolved.n_empty > 0:
                 break
-            if no_solutions or not needs_clarification:
-                fail = True
-                continue
+            if not needs_clarification:
+                return relations
+            if give_up is not None and give_up(len(relations)):
+                return None
 
-            i, j = item = random.choice(needs_clarification)
+            k = rng.randrange(len(needs_clarification))
+            i, j = needs_clarification[k]
             next2_i, next2_j = None, None
             if level >= 2 and len(needs_clarification) > 1:
-                needs_clarification.remove(item)
-                next2_i, next2_j = random.choice(needs_clarification)
+                # any other unresolved cell
+                k2 = rng.randrange(len(needs_clarification) - 1)
+                next2_i, next2_j = needs_clarification[k2 + (k2 >= k)]
 
             neighbours = []
             right_neighbours = []
@@ -328,9 +390,9 @@ def generate_puzzle(table: List[List[str]], *,
                         right_neighbours.append(new_item)
             if not neighbours:
                 continue
-            next_i, next_j = random.choice(neighbours)
+            next_i, next_j = rng.choice(neighbours)
             if level >= 2 and next2_i is None and right_neighbours:
-                next2_i, next2_j = random.choice(right_neighbours)
+                next2_i, next2_j = rng.choice(right_neighbours)
 
             permutations3 = [
                 ((i, j), (next_i, next_j), (next2_i, next2_j)), ((i, j), (next2_i, next2_j), (next_i, next_j)),
@@ -343,52 +405,151 @@ def generate_puzzle(table: List[List[str]], *,
             ] if next2_i is not None else [
                 ((i, j), (next_i, next_j)), ((next_i, next_j), (i, j))
             ]
+            # the rules are looked up by the positions of the cells, the text is formatted for the chosen one
             possible_variants = []
-            for (n_args, cmp_function, str_variants, *flags) in rules_for_relations:
-                if n_args == 3:
-                    for items in permutations3:
-                        (ti, tj), (t_next_i, t_next_j), (t_next2_i, t_next2_j) = items
-                        if flags and flags[0] and (ti == t_next_i or ti == t_next2_i or t_next_i == t_next2_i):
-                            continue
-                        if cmp_function(tj, t_next_j, t_next2_j):
-                            possible_variants.append((n_args, items, cmp_function, random.choice(str_variants)))
-                elif n_args == 2:
-                    for items in permutations2:
-                        (ti, tj), (t_next_i, t_next_j) = items
-                        if flags and flags[0] and ti == t_next_i:
-                            continue
-                        if cmp_function(tj, t_next_j):
-                            possible_variants.append((n_args, items, cmp_function, random.choice(str_variants)))
-                elif n_args == 1 and cmp_function(j):
-                    possible_variants.append((n_args, [(i, j)], cmp_function, random.choice(str_variants)))
+            for items in permutations3 + permutations2 + [((i, j),)]:
+                rows = [ti for ti, _ in items]
+                for rule in catalog.get(tuple(tj for _, tj in items), ()):
+                    if rule[2] and len(set(rows)) < len(rows):
+                        continue
+                    possible_variants.append((items, rule))
             if not possible_variants:
                 continue
 
-            n_args, list_of_ij, cmp_function, string_format = random.choice(possible_variants)
+            if lookahead:
+                variants = rng.sample(possible_variants, min(lookahead, len(possible_variants)))
+                scores = []
+                n_candidates = sum(mask.bit_count() for row in domains for mask in row)
+                # trials do not count as prunes of the relations, so they do not change the revision order
+                pruned = list(propagator.pruned)
+                for list_of_ij, (kind, _, _) in variants:
+                    ins, vns = [i for i, _ in list_of_ij], [j for _, j in list_of_ij]
+                    r = propagator.add_relation((ins, vns, kind))
+                    trial_trail = []
+                    # a relation holds for the answer, so it cannot lead to a contradiction
+                    propagator.propagate(domains, [], trial_trail, [r])
+                    scores.append(n_candidates - sum(mask.bit_count() for row in domains for mask in row))
+                    undo(trial_trail, 0)
+                    propagator.remove_last_relation()
+                    propagator.pruned[:] = pruned
+                variant = rng.choices(variants, scores)[0] if any(scores) else rng.choice(variants)
+            else:
+                variant = rng.choice(possible_variants)
+            list_of_ij, (kind, str_variants, _) = variant
+            string_format = rng.choice(str_variants)
             list_for_format = []
-            ins, wns = [], []
+            ins, vns = [], []
             for i, j in list_of_ij:
                 list_for_format.extend([table[i][0], table_wo_left[i][j]])
                 ins.append(i)
-                wns.append(table_wo_left[i][j])
-            relations.append((ins, wns, cmp_function, string_format.format(*list_for_format)))
+                vns.append(j)  # the value index of a word is its column in the answer
+            r = propagator.add_relation((ins, vns, kind,
+                                         string_format.format(*list_for_format)))
 
-            changed = True
-            while changed:
-                changed = update_ranges(relations, ranges)
+            consistent = propagator.propagate(domains, [], trail, [r])
+            unresolved.update(trail)
 
-        if not fail:
-            if minimal_conditions and not is_minimized and not time_elapsed:
-                continue
-            break
+
+_best = None  # the best try of a portfolio as one number (see `_portfolio_try`), shared with pool workers
+
+
+def _init_portfolio_worker(best):
+    global _best
+    _best = best
+
+
+def _portfolio_try(table, level, alldifferent, lookahead, seed, k, n_tries, best=None):
+    """Try `k` of `n_tries` with its own `seed`. The best finished try (fewest relations, then lowest index)
+    is kept in `best` as (number of relations) * n_tries + k, a try stops once it cannot beat it."""
+    best = best if best is not None else _best
+
+    def give_up(n_relations):
+        # an unsolved grid gets at least one more relation
+        return (n_relations + 1) * n_tries + k > best.value
+
+    relations = build_relations(table, level, alldifferent, random.Random(seed), give_up, lookahead)
+    if relations is not None:
+        with best.get_lock():
+            best.value = min(best.value, len(relations) * n_tries + k)
+    return relations
+
+
+def portfolio_relations(table: List[List[str]], level: int, alldifferent: Literal['singles', 'matching'],
+                        seeds: List[int], workers: int = 1, lookahead: int = 0) -> list:
+    """The relations of the best of independent tries, one try per seed: the fewest relations, the first try
+    among equals. With `workers` > 1 the tries run on a process pool. The tries share the best so far, a try
+    stops as soon as it cannot beat it, and the best try does not depend on the order in which tries finish,
+    so the result depends only on `seeds`."""
+    n_tries = len(seeds)
+    context = multiprocessing.get_context()
+    best = context.Value('q', 1 << 62)
+    if workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(workers, mp_context=context, initializer=_init_portfolio_worker,
+                                                    initargs=(best,)) as executor:
+            futures = [executor.submit(_portfolio_try, table, level, alldifferent, lookahead, seed, k, n_tries)
+                       for k, seed in enumerate(seeds)]
+            results = [future.result() for future in futures]
+    else:
+        results = [_portfolio_try(table, level, alldifferent, lookahead, seed, k, n_tries, best)
+                   for k, seed in enumerate(seeds)]
+    k = best.value % n_tries
+    return results[k]
+
+
+def generate_puzzle(table: List[List[str]], *,
+                    level: Literal[1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20],
+                    minimal_conditions: bool = False, max_seconds_for_minimizing: float = None,
+                    tries: int = 10, alldifferent: Literal['singles', 'matching'] = 'singles',
+                    max_seconds_per_check: float = None, max_nodes_per_check: int = None,
+                    minimization: Literal['chunks', 'one_by_one'] = 'chunks', workers: int = 1, lookahead: int = 0):
+    if level not in range(1, 20 + 1):
+        raise ValueError('level must be >= 1 and <= 20')
+    if alldifferent not in ('singles', 'matching'):
+        raise ValueError("alldifferent must be 'singles' or 'matching'")
+    if minimization not in ('chunks', 'one_by_one'):
+        raise ValueError("minimization must be 'chunks' or 'one_by_one'")
+    if workers < 1:
+        raise ValueError('workers must be >= 1')
+    if tries < 1:
+        raise ValueError('tries must be >= 1')
+    if lookahead < 0:
+        raise ValueError('lookahead must be >= 0')
+
+    table_wo_left = [row[1:] for row in table]
+    n_attributes = len(table_wo_left)
+    m_objects = len(table_wo_left[0])
+
+    if level >= 19 and m_objects == 2:
+        raise ValueError('too few objects for level >= 19')
+    elif m_objects <= 1:
+        raise ValueError('m_objects must be >= 2')
+    elif n_attributes <= 0:
+        raise ValueError('n_attributes must be >= 1')
+
+    def is_unique(relations):
+        # a check that runs out of budget is undecided, so the relation is kept
+        return check_unique(relations, n_attributes, m_objects, alldifferent,
+                            Budget(max_seconds_per_check, max_nodes_per_check))
+
+    # every try has its own seed drawn from `random`, so the result does not depend on `workers`
+    seeds = [random.getrandbits(64) for _ in range(tries)]
+    relations = portfolio_relations(table, level, alldifferent, seeds, workers, lookahead)
+    if minimal_conditions:
+        deadline = time.monotonic() + max_seconds_for_minimizing if max_seconds_for_minimizing is not None else None
+        pool = UniquenessPool(workers, n_attributes, m_objects, alldifferent, max_seconds_per_check,
+                              max_nodes_per_check) if workers > 1 else None
+        try:
+            relations, _ = minimize_relations(relations, is_unique, deadline, minimization == 'one_by_one', pool)
+        finally:
+            if pool is not None:
+                pool.close()
 
     premises = [t[-1] for t in relations]
     random.shuffle(premises)
     return premises
 
 
-def main():
-    kinds_dict = {
+kinds_dict = {
         "Name": {
 		"Eleanor", "Graham", "Jonah", "Karolina", "Yong", 
 		"Vijay", "Halima", "Sizwe", "Lautaro", "Marama"
@@ -422,7 +583,172 @@ def main():
 		"significant-other", "parents", "grandparents", "friend", "bird"
 	}
 	
-    }
+}
+
+
+def format_puzzle(table: List[List[str]], level: int, premises: List[str]) -> str:
+    """A puzzle block of the `puzzles/*.txt` files, without the separator line before it."""
+    header = [str(i) for i in range(1, len(table[0]))]
+    indent = len(str(len(premises)))
+    lines = [f'.:: Puzzle {len(table)}x{len(table[0]) - 1} level={level} ::.']
+    lines += [f"{row[0]}: " + ', '.join(sorted(row[1:])) for row in table]
+    lines += [f"{str(i).rjust(indent)}. {premise}" for i, premise in enumerate(premises, 1)]
+    lines += ['', '.:: Answer ::.', format_table(header, table)]
+    return '\n'.join(lines) + '\n'
+
+
+def _generate_batch_item(n_attributes: int, m_objects: int, level: int, seed: int, options: dict):
+    """The table and premises of one puzzle of `generate_batch`, they depend only on the arguments."""
+    random.seed(f'{n_attributes}x{m_objects} level={level} seed={seed}')
+    chosen_kinds = sorted(random.sample(sorted(kinds_dict), k=n_attributes))
+    table = [[kind] + random.sample(sorted(kinds_dict[kind]), k=m_objects) for kind in chosen_kinds]
+    return table, generate_puzzle(table, level=level, **options)
+
+
+def generate_batch(out_dir: str, attributes: Iterable[int], objects: Iterable[int], levels: Iterable[int],
+                   seeds: Iterable[int], *, shard_index: int = 0, shard_count: int = 1, workers: int = None,
+                   jsonl: bool = False, flush_every: int = 100, **options):
+    """Generate a puzzle for every (attributes, objects, level, seed), `options` go to `generate_puzzle`.
+
+    Every puzzle depends only on its (attributes, objects, level, seed), so machines can share the work: this
+    call generates the puzzles whose index in that order is `shard_index` modulo `shard_count`. Puzzles are
+    generated by `workers` processes (all cores by default) and written in order to `{n}x{m}.{shard}.txt`
+    files of `out_dir` in the format of `puzzles/*.txt`, with `jsonl` also as JSON lines. Every `flush_every`
+    puzzles the files are flushed and a checkpoint with the finished puzzles and the file sizes is appended
+    to `checkpoint.{shard}.jsonl`. A new call with the same shard truncates the files to the last checkpoint
+    and skips the puzzles it has finished."""
+    if not 0 <= shard_index < shard_count:
+        raise ValueError('shard_index must be >= 0 and < shard_count')
+    kinds_sizes = [len(words) for words in kinds_dict.values()]
+    attributes, objects, levels = tuple(attributes), tuple(objects), tuple(levels)
+    if (any(n > len(kinds_dict) or n < 1 for n in attributes) or any(m < 2 or m > min(kinds_sizes) for m in objects)
+            or any(level not in range(1, 20 + 1) for level in levels)):
+        raise ValueError(f'attributes must be 1..{len(kinds_dict)}, objects 2..{min(kinds_sizes)}, levels 1..20')
+    shard = f'{shard_index}of{shard_count}'
+    os.makedirs(out_dir, exist_ok=True)
+    checkpoint_path = os.path.join(out_dir, f'checkpoint.{shard}.jsonl')
+    done, sizes = set(), {}
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as checkpoint_file:
+            for line in checkpoint_file:
+                checkpoint = json.loads(line)
+                done.update(tuple(item) for item in checkpoint['done'])
+                sizes = checkpoint['sizes']
+    # puzzles written after the last checkpoint are generated again
+    for name in os.listdir(out_dir):
+        if name.endswith((f'.{shard}.txt', f'.{shard}.jsonl')) and name != os.path.basename(checkpoint_path):
+            with open(os.path.join(out_dir, name), 'r+') as file:
+                file.truncate(sizes.get(name, 0))
+    # the items are enumerated lazily, a batch can have far more of them than fit in memory
+    items = ((n, m, level, seed) for n, m, level, seed in itertools.product(attributes, objects, levels, seeds)
+             if not (level >= 19 and m == 2))
+    items = (item for k, item in enumerate(items) if k % shard_count == shard_index and item not in done)
+
+    files = {}
+
+    def write(name, text):
+        if name not in files:
+            files[name] = open(os.path.join(out_dir, name), 'a')
+        files[name].write(text)
+
+    def save_checkpoint(finished):
+        for file in files.values():
+            file.flush()
+        # files of earlier calls that this call has not written to keep their sizes
+        sizes.update({name: os.path.getsize(os.path.join(out_dir, name)) for name in files})
+        with open(checkpoint_path, 'a') as checkpoint_file:
+            checkpoint_file.write(json.dumps({'done': finished, 'sizes': sizes}) + '\n')
+
+    workers = workers or os.cpu_count()
+    finished = []
+    try:
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            futures = collections.deque()
+            while True:
+                # keep a few puzzles per worker queued, results are written in the order of the items
+                while len(futures) < 4 * workers:
+                    item = next(items, None)
+                    if item is None:
+                        break
+                    futures.append((item, executor.submit(_generate_batch_item, *item, options)))
+                if not futures:
+                    break
+                (n, m, level, seed), future = futures.popleft()
+                table, premises = future.result()
+                write(f'{n}x{m}.{shard}.txt', '=' * 100 + '\n' + format_puzzle(table, level, premises))
+                if jsonl:
+                    write(f'{n}x{m}.{shard}.jsonl', json.dumps({
+                        'n_attributes': n, 'm_objects': m, 'level': level, 'seed': seed,
+                        'table': table, 'premises': premises}) + '\n')
+                finished.append((n, m, level, seed))
+                if len(finished) >= flush_every:
+                    save_checkpoint(finished)
+                    finished = []
+            save_checkpoint(finished)
+    finally:
+        for file in files.values():
+            file.close()
+    # the closing separator of the .txt files is not part of the checkpointed sizes
+    for name in os.listdir(out_dir):
+        if name.endswith(f'.{shard}.txt'):
+            with open(os.path.join(out_dir, name), 'a') as file:
+                file.write('=' * 100 + '\n')
+
+
+def benchmark_lookahead(n_attributes: int, m_objects: int, levels: Iterable[int] = range(1, 20 + 1),
+                        seeds: Iterable[int] = range(10), lookahead: int = 8, **options) -> List[Tuple[int, ...]]:
+    """Generate the puzzles of `generate_batch` for every level and seed with random clue selection and with
+    `lookahead`, print and return (level, clues, clues with lookahead, seconds, seconds with lookahead) per
+    level, summed over the seeds. `options` go to `generate_puzzle`. The state of `random` is restored."""
+    rows = []
+    # the puzzles are seeded through `random`, the caller keeps its own sequence
+    state = random.getstate()
+    try:
+        print(f'{"level":>5} {"clues":>7} {"lookahead":>9} {"seconds":>8} {"lookahead":>9}')
+        for level in levels:
+            row = [level, 0, 0, 0.0, 0.0]
+            for seed in seeds:
+                for k, selection in enumerate(({}, {'lookahead': lookahead})):
+                    start = time.perf_counter()
+                    _, premises = _generate_batch_item(n_attributes, m_objects, level, seed,
+                                                       {**options, **selection})
+                    row[1 + k] += len(premises)
+                    row[3 + k] += time.perf_counter() - start
+            rows.append(tuple(row))
+            print(f'{row[0]:>5} {row[1]:>7} {row[2]:>9} {row[3]:>8.2f} {row[4]:>9.2f}')
+    finally:
+        random.setstate(state)
+    return rows
+
+
+def _int_range(text: str) -> range:
+    """'3' or an inclusive range '2-5'."""
+    first, _, last = text.partition('-')
+    return range(int(first), int(last or first) + 1)
+
+
+def batch_main(argv: List[str]):
+    parser = argparse.ArgumentParser(description='Generate puzzles for every size, level and seed, see '
+                                                 '`generate_batch`.')
+    parser.add_argument('--attributes', type=_int_range, default='2-5', help="e.g. '4' or '2-5'")
+    parser.add_argument('--objects', type=_int_range, default='3-5', help="e.g. '5' or '3-5'")
+    parser.add_argument('--levels', type=_int_range, default='1-20', help="e.g. '12' or '1-20'")
+    parser.add_argument('--seeds', type=_int_range, default='0-99', help="e.g. '0-99999'")
+    parser.add_argument('--shard', default='0/1', help="'index/count', e.g. '2/8' for the third of 8 machines")
+    parser.add_argument('--workers', type=int, default=None, help='processes, all cores by default')
+    parser.add_argument('--out', default='batch', help='output directory')
+    parser.add_argument('--jsonl', action='store_true', help='also write JSON lines')
+    parser.add_argument('--minimal', action='store_true', help='minimize the number of conditions')
+    parser.add_argument('--max-seconds-for-minimizing', type=float, default=None)
+    parser.add_argument('--tries', type=int, default=10)
+    args = parser.parse_args(argv)
+    shard_index, shard_count = map(int, args.shard.split('/'))
+    generate_batch(args.out, args.attributes, args.objects, args.levels, args.seeds, shard_index=shard_index,
+                   shard_count=shard_count, workers=args.workers, jsonl=args.jsonl, tries=args.tries,
+                   minimal_conditions=args.minimal, max_seconds_for_minimizing=args.max_seconds_for_minimizing)
+
+
+def main():
     kinds = sorted(kinds_dict)
     n_attributes = 8
     m_objects = 10
@@ -453,4 +779,7 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1:
+        batch_main(sys.argv[1:])
+    else:
+        main()
@@ -1,6 +1,20 @@
+import abc
 import time
+import heapq
+import types
+import shelve
+import hashlib
+import functools
+import dataclasses
 import collections
-from typing import Union, Tuple, List, Set, Callable
+import multiprocessing
+import concurrent.futures
+from typing import Literal, Union, Tuple, List, Dict, Set, FrozenSet, Callable
+
+try:
+    import numpy
+except ImportError:  # numpy is optional, `solve_puzzles` propagates puzzle by puzzle without it
+    numpy = None
 
 
 def format_table(table: List[List[str]]) -> str:
@@ -60,38 +74,941 @@ def update_range(wns: List[str], rns: List[List[Set[str]]], cmp: Callable):
 
 
 def update_ranges(relations: List[Tuple[List[int], List[str], Callable, ...]],
-                  ranges: List[List[Set[str]]]):
+                  ranges: List[List[Set[str]]],
+                  stats: 'SolverStats' = None,
+                  relation_indices: Union[List[int], None] = None):
+    if stats is None:
+        changed = False
+        for ins, wns, callable_object, *_ in relations:
+            changed |= update_range(wns, [ranges[i] for i in ins], callable_object)
+        return changed
+
+    start = time.perf_counter()
     changed = False
-    for ins, wns, callable_object, *_ in relations:
-        changed |= update_range(wns, [ranges[i] for i in ins], callable_object)
+    for r, (ins, wns, callable_object, *_) in enumerate(relations):
+        n_words = sum(len(set_of_words) for i in set(ins) for set_of_words in ranges[i])
+        if update_range(wns, [ranges[i] for i in ins], callable_object):
+            changed = True
+            r = relation_indices[r] if relation_indices is not None else r
+            n_pruned = n_words - sum(len(set_of_words) for i in set(ins) for set_of_words in ranges[i])
+            stats.relation_prunes[r] = stats.relation_prunes.get(r, 0) + n_pruned
+    stats.passes += 1
+    stats.revisions += len(relations)
+    stats.propagate_seconds += time.perf_counter() - start
     return changed
 
 
+_truth_tables = collections.OrderedDict()  # (callable descriptor, n_args, m_objects) -> table, least recent first
+_truth_table_misses = 0  # tables built by `truth_table`
+
+
+def truth_table(callable_objects: Union[Callable, FrozenSet[Callable]], n_args: int, m_objects: int):
+    """Evaluate a relation once for every tuple of positions.
+
+    The table of a relation with one argument is the bitmask of admissible positions, the table of a relation
+    with `n_args` arguments is a tuple indexed by the position of the first argument that holds the table of
+    the remaining arguments. Tables depend only on positions, so they are cached and shared by all passes,
+    branches and puzzles. The 1024 most recent tables are kept under `callable_descriptor`, so a lambda that
+    reads globals or closure cells gets a new table once their values change. Other callable objects are
+    described by their `repr` and must not change their results."""
+    global _truth_table_misses
+    key = (callable_descriptor(callable_objects), n_args, m_objects)
+    if key in _truth_tables:
+        _truth_tables.move_to_end(key)
+        return _truth_tables[key]
+    callables = (callable_objects,) if callable(callable_objects) else callable_objects
+
+    def build(prefix):
+        if len(prefix) == n_args - 1:
+            mask = 0
+            for j in range(m_objects):
+                if all(callable_object(*prefix, j) for callable_object in callables):
+                    mask |= 1 << j
+            return mask
+        return tuple(build((*prefix, j)) for j in range(m_objects))
+
+    _truth_table_misses += 1
+    table = _truth_tables[key] = build(())
+    if len(_truth_tables) > 1024:
+        _truth_tables.popitem(last=False)
+    return table
+
+
+def _below(mask: int) -> int:
+    """Positions strictly below the highest position of `mask`."""
+    return (1 << (mask.bit_length() - 1)) - 1 if mask else 0
+
+
+def _above(mask: int) -> int:
+    """Positions strictly above the lowest position of `mask` (an infinite mask, meant for `&`)."""
+    return -((mask & -mask) << 1) if mask else 0
+
+
+def _shift(mask: int, delta: int) -> int:
+    """`mask` moved by `delta` positions."""
+    return mask << delta if delta >= 0 else mask >> -delta
+
+
+@functools.lru_cache(maxsize=64)
+def _parity_mask(width: int, remainder: int) -> int:
+    """Positions below `width` with the parity `remainder`."""
+    return sum(1 << j for j in range(remainder, width, 2))
+
+
+class RelationKind(abc.ABC):
+    """A declarative relation between the positions of its arguments.
+
+    A kind is called with positions like any callable relation, so it works with `truth_table` and the sets
+    engine. Kinds are hashable and picklable, and the bitset engine revises them with `supports` in time
+    linear in the number of positions instead of enumerating position tuples."""
+    n_args: int
+
+    @abc.abstractmethod
+    def __call__(self, *positions: int) -> bool:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def supports(self, masks: List[int]) -> List[int]:
+        """Positions of every argument that have a support within `masks`, like `relation_supports`."""
+        raise NotImplementedError
+
+
+@dataclasses.dataclass(frozen=True)
+class Same(RelationKind):
+    """c1 == c2."""
+    n_args = 2
+
+    def __call__(self, c1, c2):
+        return c1 == c2
+
+    def supports(self, masks):
+        common = masks[0] & masks[1]
+        return [common, common]
+
+
+@dataclasses.dataclass(frozen=True)
+class Offset(RelationKind):
+    """c1 - c2 is one of `deltas`: (-1,) is "on the left of", (1,) "on the right of", (-1, 1) "next to"."""
+    deltas: Tuple[int, ...]
+    n_args = 2
+
+    def __call__(self, c1, c2):
+        return c1 - c2 in self.deltas
+
+    def supports(self, masks):
+        first, second = masks
+        supports = [0, 0]
+        for delta in self.deltas:
+            supports[0] |= first & _shift(second, delta)
+            supports[1] |= second & _shift(first, -delta)
+        return supports
+
+
+@dataclasses.dataclass(frozen=True)
+class Compare(RelationKind):
+    """c1 `op` c2, where `op` is one of '<', '<=', '>', '>=', '!='."""
+    op: Literal['<', '<=', '>', '>=', '!=']
+    n_args = 2
+
+    def __post_init__(self):
+        if self.op not in ('<', '<=', '>', '>=', '!='):
+            raise ValueError("op must be one of '<', '<=', '>', '>=', '!='")
+
+    def __call__(self, c1, c2):
+        if self.op == '<':
+            return c1 < c2
+        elif self.op == '<=':
+            return c1 <= c2
+        elif self.op == '>':
+            return c1 > c2
+        elif self.op == '>=':
+            return c1 >= c2
+        return c1 != c2
+
+    def supports(self, masks):
+        first, second = masks
+        if self.op == '!=':
+            # only a fixed position of one argument is taken from the other
+            return [first & ~second if not second & (second - 1) else first,
+                    second & ~first if not first & (first - 1) else second]
+        if self.op in ('>', '>='):
+            second, first = first, second
+        if self.op in ('<', '>'):
+            supports = [first & _below(second), second & _above(first)]
+        else:
+            supports = [first & _below(second << 1), second & -(first & -first)]
+        return supports if self.op in ('<', '<=') else supports[::-1]
+
+
+@dataclasses.dataclass(frozen=True)
+class At(RelationKind):
+    """c1 is one of `positions` ("on the far left", "in the middle", "at one of the ends")."""
+    positions: FrozenSet[int]
+    n_args = 1
+
+    def __call__(self, c1):
+        return c1 in self.positions
+
+    def supports(self, masks):
+        allowed = 0
+        for position in self.positions:
+            allowed |= 1 << position
+        return [masks[0] & allowed]
+
+
+@dataclasses.dataclass(frozen=True)
+class Parity(RelationKind):
+    """c1 % 2 == `remainder` (remainder 0 is an odd position counting from 1)."""
+    remainder: int
+    n_args = 1
+
+    def __call__(self, c1):
+        return c1 % 2 == self.remainder
+
+    def supports(self, masks):
+        return [masks[0] & _parity_mask(masks[0].bit_length(), self.remainder)]
+
+
+@dataclasses.dataclass(frozen=True)
+class SameParity(RelationKind):
+    """c1 and c2 have the same parity if `same`, different parities otherwise."""
+    same: bool
+    n_args = 2
+
+    def __call__(self, c1, c2):
+        return (c1 % 2 == c2 % 2) == self.same
+
+    def supports(self, masks):
+        first, second = masks
+        width = max(first.bit_length(), second.bit_length())
+        supports = [0, 0]
+        for r in (0, 1):
+            first_r = first & _parity_mask(width, r)
+            second_r = second & _parity_mask(width, r if self.same else 1 - r)
+            if first_r and second_r:
+                supports[0] |= first_r
+                supports[1] |= second_r
+        return supports
+
+
+@dataclasses.dataclass(frozen=True)
+class Between(RelationKind):
+    """c1 is between c2 and c3: right between them if `adjacent`, somewhere between them otherwise.
+    Unless `ordered`, c2 and c3 may be on either side."""
+    adjacent: bool
+    ordered: bool = False
+    n_args = 3
+
+    def __call__(self, c1, c2, c3):
+        if self.adjacent:
+            return c2 + 1 == c1 == c3 - 1 or not self.ordered and c3 + 1 == c1 == c2 - 1
+        return c2 < c1 < c3 or not self.ordered and c3 < c1 < c2
+
+    def _oriented(self, middle, low, high):
+        """Supports of `middle`, `low` and `high` when `low` is on the left."""
+        if self.adjacent:
+            middle &= low << 1 & high >> 1
+            return middle, low & middle >> 1, high & middle << 1
+        middle &= _above(low) & _below(high)
+        return middle, low & _below(middle), high & _above(middle)
+
+    def supports(self, masks):
+        middle, second, third = masks
+        supports = list(self._oriented(middle, second, third))
+        if not self.ordered:
+            middle_2, third_2, second_2 = self._oriented(middle, third, second)
+            supports = [supports[0] | middle_2, supports[1] | second_2, supports[2] | third_2]
+        return supports
+
+
+@dataclasses.dataclass(frozen=True)
+class Or(RelationKind):
+    """At least one of `parts` holds, a part is (kind, indices of its arguments among the arguments of Or):
+    Or(((Same(), (0, 1)), (Same(), (0, 2)))) is "c1 == c2 or c1 == c3 or both"."""
+    parts: Tuple[Tuple[RelationKind, Tuple[int, ...]], ...]
+
+    @property
+    def n_args(self):
+        return 1 + max(max(args) for _, args in self.parts)
+
+    def __call__(self, *positions):
+        return any(kind(*(positions[a] for a in args)) for kind, args in self.parts)
+
+    def supports(self, masks):
+        supports = [0] * len(masks)
+        for kind, args in self.parts:
+            part_supports = kind.supports([masks[a] for a in args])
+            if all(part_supports):
+                # a satisfied part supports every position of the arguments it does not mention
+                for a, mask in enumerate(masks):
+                    if a not in args:
+                        supports[a] |= mask
+                for a, support in zip(args, part_supports):
+                    supports[a] |= support
+        return supports
+
+
+@dataclasses.dataclass(frozen=True)
+class Xor(RelationKind):
+    """Exactly one of two binary `parts` holds, the parts share one argument:
+    Xor(((Same(), (0, 1)), (Same(), (0, 2)))) is "c1 == c2 or c1 == c3, but not both"."""
+    parts: Tuple[Tuple[RelationKind, Tuple[int, int]], Tuple[RelationKind, Tuple[int, int]]]
+
+    def __post_init__(self):
+        (_, args_1), (_, args_2) = self.parts
+        if len(args_1) != 2 or len(args_2) != 2 or len(set(args_1) & set(args_2)) != 1:
+            raise ValueError('Xor needs two binary parts that share one argument')
+
+    @property
+    def n_args(self):
+        return 1 + max(max(args) for _, args in self.parts)
+
+    def __call__(self, *positions):
+        (kind_1, args_1), (kind_2, args_2) = self.parts
+        return kind_1(*(positions[a] for a in args_1)) != kind_2(*(positions[a] for a in args_2))
+
+    def supports(self, masks):
+        (kind_1, args_1), (kind_2, args_2) = self.parts
+        shared, = set(args_1) & set(args_2)
+        other_1, = set(args_1) - {shared}
+        other_2, = set(args_2) - {shared}
+        supports = [0] * len(masks)
+        # every position of the shared argument splits the other arguments into positions where a part holds
+        shared_mask = masks[shared]
+        while shared_mask:
+            bit = shared_mask & -shared_mask
+            shared_mask ^= bit
+            holds = []
+            for kind, args, other in ((kind_1, args_1, other_1), (kind_2, args_2, other_2)):
+                part_masks = [bit if a == shared else masks[a] for a in args]
+                holds.append(kind.supports(part_masks)[args.index(other)])
+            fails = [masks[other_1] & ~holds[0], masks[other_2] & ~holds[1]]
+            for first, second in ((holds[0], fails[1]), (fails[0], holds[1])):
+                if first and second:
+                    supports[shared] |= bit
+                    supports[other_1] |= first
+                    supports[other_2] |= second
+        return supports
+
+
+def compile_table(callable_objects: Union[Callable, FrozenSet[Callable]], n_args: int, m_objects: int):
+    """A single relation kind as it is, it has its own propagator, otherwise the `truth_table` of the callables."""
+    if isinstance(callable_objects, RelationKind):
+        return callable_objects
+    if not callable(callable_objects) and len(callable_objects) == 1:
+        callable_object, = callable_objects
+        if isinstance(callable_object, RelationKind):
+            return callable_object
+    return truth_table(callable_objects, n_args, m_objects)
+
+
+def _supports(table, masks: List[int]) -> List[int]:
+    """Positions of every argument that have a support in `table` within `masks`."""
+    first, *others = masks
+    if not others:
+        return [table & first]
+    supports = [0] * len(masks)
+    while first:
+        bit = first & -first
+        first ^= bit
+        sub_supports = _supports(table[bit.bit_length() - 1], others)
+        if sub_supports[-1]:
+            supports[0] |= bit
+            for k, support in enumerate(sub_supports, 1):
+                supports[k] |= support
+    return supports
+
+
+def relation_supports(table, masks: List[int]) -> List[int]:
+    """Positions of every argument of a relation that have a support in its `truth_table` (or its own
+    propagator for a `RelationKind`, see `compile_table`) within `masks`."""
+    if isinstance(table, RelationKind):
+        return table.supports(masks)
+    if len(masks) == 1:
+        return [table & masks[0]]
+    elif len(masks) == 2:
+        first, second = masks
+        supports = [0, 0]
+        while first:
+            bit = first & -first
+            first ^= bit
+            support = table[bit.bit_length() - 1] & second
+            if support:
+                supports[0] |= bit
+                supports[1] |= support
+        return supports
+    return _supports(table, masks)
+
+
+def update_row(row: List[int], trail: Union[list, None] = None) -> bool:
+    """Naked and hidden singles of one attribute row, `row` maps a value index to the bitmask of positions
+    where the value may still be placed. Old masks are recorded on `trail` if it is given."""
+    changed = False
+    # naked singles: a position that only one value can take is given to that value
+    once, twice = 0, 0
+    for mask in row:
+        twice |= once & mask
+        once |= mask
+    unique = once & ~twice
+    if unique:
+        for v, mask in enumerate(row):
+            if mask & unique and mask & (mask - 1):
+                if trail is not None:
+                    trail.append((row, v, mask))
+                row[v] = mask & unique & -(mask & unique)
+                changed = True
+    # hidden singles: a value that has only one position takes this position from other values
+    classified = 0
+    for mask in row:
+        if mask and not mask & (mask - 1):
+            classified |= mask
+    for v, mask in enumerate(row):
+        if mask & (mask - 1) and mask & classified:
+            if trail is not None:
+                trail.append((row, v, mask))
+            row[v] = mask & ~classified
+            changed = True
+    return changed
+
+
+def update_row_matching(row: List[int], trail: Union[list, None] = None) -> bool:
+    """All-different filtering of one attribute row by bipartite matching (Regin), stronger than `update_row`:
+    every Hall set (k values whose masks together hold only k positions) takes its positions from the
+    other values. A position stays in a mask only if some perfect matching of values to positions uses it.
+    If the row has no perfect matching, the mask of an unmatched value is emptied."""
+    n = len(row)
+    value_at = [-1] * n  # position -> matched value
+    position_of = [-1] * n  # value -> matched position
+
+    def augment(v, visited):
+        free = row[v] & ~visited
+        while free:
+            bit = free & -free
+            free ^= bit
+            visited |= bit
+            p = bit.bit_length() - 1
+            if value_at[p] < 0:
+                value_at[p], position_of[v] = v, p
+                return visited, True
+            visited, found = augment(value_at[p], visited)
+            if found:
+                value_at[p], position_of[v] = v, p
+                return visited, True
+            free &= ~visited
+        return visited, False
+
+    for v in range(n):
+        if not augment(v, 0)[1]:
+            if trail is not None:
+                trail.append((row, v, row[v]))
+            row[v] = 0
+            return True
+
+    # strongly connected components of values, value v -> value u if v may take the position of u
+    index, low, component = [-1] * n, [0] * n, [-1] * n
+    stack, on_stack = [], [False] * n
+    counter = 0
+
+    def connect(v):
+        nonlocal counter
+        index[v] = low[v] = counter
+        counter += 1
+        stack.append(v)
+        on_stack[v] = True
+        others = row[v] & ~(1 << position_of[v])
+        while others:
+            bit = others & -others
+            others ^= bit
+            u = value_at[bit.bit_length() - 1]
+            if index[u] < 0:
+                connect(u)
+                low[v] = min(low[v], low[u])
+            elif on_stack[u]:
+                low[v] = min(low[v], index[u])
+        if low[v] == index[v]:
+            while True:
+                u = stack.pop()
+                on_stack[u] = False
+                component[u] = v
+                if u == v:
+                    break
+
+    for v in range(n):
+        if index[v] < 0:
+            connect(v)
+
+    # a position is kept if it is matched or its value is in the same component
+    changed = False
+    for v, mask in enumerate(row):
+        kept = 1 << position_of[v]
+        others = mask & ~kept
+        while others:
+            bit = others & -others
+            others ^= bit
+            if component[value_at[bit.bit_length() - 1]] == component[v]:
+                kept |= bit
+        if kept != mask:
+            if trail is not None:
+                trail.append((row, v, mask))
+            row[v] = kept
+            changed = True
+    return changed
+
+
+@dataclasses.dataclass
+class SolverStats:
+    revisions: int = 0  # relation revisions done by the worklist (`update_range` calls of the sets engine)
+    revisions_saved: int = 0  # per pass, relations that a sweep would have revised but the worklist did not
+    nogood_prunes: int = 0  # branches skipped without propagation because they completed a learned nogood
+    passes: int = 0  # propagation passes: worklist runs, or sweeps over all relations of the sets engine
+    row_updates: int = 0  # row (all-different) filter calls
+    evaluations: int = 0  # relation callable calls of the sets engine, truth table entries built by the bitset engine
+    nodes: int = 0  # search nodes (branches tried)
+    max_depth: int = 0  # longest BFS queue, DFS stack or DLX recursion
+    peak_grids: int = 0  # most copies of the domains alive at once during the search
+    propagate_seconds: float = 0.0  # time spent propagating, in the search too
+    search_seconds: float = 0.0  # time spent searching complex tasks, propagation included
+    relation_prunes: Dict[int, int] = dataclasses.field(default_factory=dict)  # relation index -> candidates it pruned
+
+    def add(self, other: 'SolverStats'):
+        """Add the counters of `other`, depths and peaks are combined by maximum."""
+        for field in dataclasses.fields(self):
+            mine, theirs = getattr(self, field.name), getattr(other, field.name)
+            if field.name == 'relation_prunes':
+                for r, n_pruned in theirs.items():
+                    mine[r] = mine.get(r, 0) + n_pruned
+            elif field.name in ('max_depth', 'peak_grids'):
+                setattr(self, field.name, max(mine, theirs))
+            else:
+                setattr(self, field.name, mine + theirs)
+
+
+class Budget:
+    """Limits of a search: `max_seconds` of wall time, `max_nodes` search nodes (branches) and a `cancel`
+    callback that returns True when the caller wants the search to stop (`threading.Event().is_set` works).
+    `spend` counts nodes and tells whether the search must stop, after that `exhausted` stays True."""
+
+    def __init__(self, max_seconds: Union[float, None] = None, max_nodes: Union[int, None] = None,
+                 cancel: Union[Callable[[], bool], None] = None):
+        self.deadline = time.monotonic() + max_seconds if max_seconds is not None else None
+        self.max_nodes = max_nodes
+        self.cancel = cancel
+        self.nodes = 0
+        self.exhausted = False
+
+    def spend(self, nodes: int = 1) -> bool:
+        self.nodes += nodes
+        if not self.exhausted:
+            self.exhausted = (self.max_nodes is not None and self.nodes > self.max_nodes
+                              or self.deadline is not None and time.monotonic() >= self.deadline
+                              or self.cancel is not None and self.cancel())
+        return self.exhausted
+
+
+class Propagator:
+    """Worklist (AC-3 style) propagation of bitset domains.
+
+    Relations are indexed by the attribute rows they touch. When a row shrinks, only the row itself and
+    the relations watching it are queued again, relations that pruned more values before are revised first.
+    Rows are filtered by `update_row`, with `alldifferent='matching'` also by `update_row_matching`. The
+    matching filter is expensive, so it runs on changed rows only once the cheap filters are at a fixpoint."""
+
+    def __init__(self, relations: List[Tuple[List[int], List[int], Union[int, tuple], ...]], n_rows: int,
+                 stats: SolverStats = None, alldifferent: Literal['singles', 'matching'] = 'singles'):
+        if alldifferent not in ('singles', 'matching'):
+            raise ValueError("alldifferent must be 'singles' or 'matching'")
+        self.relations = relations
+        self.matching = alldifferent == 'matching'
+        self.watchers = [[] for _ in range(n_rows)]
+        for r, (ins, *_) in enumerate(relations):
+            for i in sorted(set(ins)):
+                self.watchers[i].append(r)
+        # a relation that mentions the same value twice is not idempotent and is queued again after itself
+        self.self_watching = [len(set(zip(ins, vns))) < len(ins) for ins, vns, *_ in relations]
+        self.pruned = [0] * len(relations)
+        self.stats = stats if stats is not None else SolverStats()
+
+    def add_relation(self, relation: Tuple[List[int], List[int], Union[int, tuple], ...]) -> int:
+        """Append a compiled relation, returns its index."""
+        ins, vns, *_ = relation
+        self.relations.append(relation)
+        for i in sorted(set(ins)):
+            self.watchers[i].append(len(self.relations) - 1)
+        self.self_watching.append(len(set(zip(ins, vns))) < len(ins))
+        self.pruned.append(0)
+        return len(self.relations) - 1
+
+    def remove_last_relation(self):
+        """Undo the last `add_relation` (or drop the last relation given to the constructor)."""
+        ins, *_ = self.relations.pop()
+        for i in sorted(set(ins)):
+            self.watchers[i].pop()
+        self.self_watching.pop()
+        self.pruned.pop()
+
+    def propagate(self, domains: List[List[int]], rows: Union[List[int], None] = None,
+                  trail: Union[list, None] = None, new_relations: Union[List[int], None] = None) -> bool:
+        """Shrink `domains` to the fixpoint of the row constraints and relations, returns False as soon as
+        some value has no position left. If `rows` is given, only these rows have changed since the last
+        fixpoint, otherwise everything is revised. `new_relations` are indices of relations that are revised
+        even if their rows have not changed, like relations added since the last fixpoint. Every overwritten
+        mask is recorded on `trail` as (row, value index, old mask) if it is given, see `undo`."""
+        start = time.perf_counter()
+        revisions = self.stats.revisions
+        try:
+            return self._propagate(domains, rows, trail, new_relations)
+        finally:
+            self.stats.passes += 1
+            # a sweep revises every relation at least once per pass
+            self.stats.revisions_saved += max(0, len(self.relations) - (self.stats.revisions - revisions))
+            self.stats.propagate_seconds += time.perf_counter() - start
+
+    def _propagate(self, domains, rows, trail, new_relations):
+        relations, watchers, pruned, stats = self.relations, self.watchers, self.pruned, self.stats
+        queued = [rows is None] * len(relations)
+        heap = [(-pruned[r], r) for r in range(len(relations))] if rows is None else []
+        heapq.heapify(heap)
+        dirty_rows = set(range(len(domains)) if rows is None else rows)
+        matching_rows = set(dirty_rows) if self.matching else None
+        if rows is not None:
+            for r in new_relations or ():
+                if not queued[r]:
+                    queued[r] = True
+                    heapq.heappush(heap, (-pruned[r], r))
+            for i in dirty_rows:
+                for r in watchers[i]:
+                    if not queued[r]:
+                        queued[r] = True
+                        heapq.heappush(heap, (-pruned[r], r))
+        while dirty_rows or heap or matching_rows:
+            if dirty_rows or not heap:
+                if dirty_rows:
+                    i = dirty_rows.pop()
+                    row = domains[i]
+                    stats.row_updates += 1
+                    if not update_row(row, trail):
+                        continue
+                    if matching_rows is not None:
+                        matching_rows.add(i)
+                else:
+                    # the matching filter is idempotent, the row is revised again only after other changes
+                    i = matching_rows.pop()
+                    row = domains[i]
+                    stats.row_updates += 1
+                    if not update_row_matching(row, trail):
+                        continue
+                if not all(row):
+                    return False
+                dirty_rows.add(i)
+                for r in watchers[i]:
+                    if not queued[r]:
+                        queued[r] = True
+                        heapq.heappush(heap, (-pruned[r], r))
+                continue
+
+            _, r = heapq.heappop(heap)
+            queued[r] = False
+            ins, vns, table, *_ = relations[r]
+            stats.revisions += 1
+            supports = relation_supports(table, [domains[i][vn] for i, vn in zip(ins, vns)])
+            shrunk_rows = []
+            for i, vn, support in zip(ins, vns, supports):
+                mask = domains[i][vn]
+                if mask & ~support:
+                    if not support:
+                        return False
+                    pruned[r] += (mask & ~support).bit_count()
+                    if trail is not None:
+                        trail.append((domains[i], vn, mask))
+                    domains[i][vn] = mask & support
+                    shrunk_rows.append(i)
+            if shrunk_rows:
+                for i in shrunk_rows:
+                    dirty_rows.add(i)
+                    if matching_rows is not None:
+                        matching_rows.add(i)
+                    for r2 in watchers[i]:
+                        if not queued[r2] and (r2 != r or self.self_watching[r]):
+                            queued[r2] = True
+                            heapq.heappush(heap, (-pruned[r2], r2))
+        return True
+
+
+def undo(trail: list, mark: int):
+    """Restore the masks recorded on `trail` after its first `mark` entries."""
+    while len(trail) > mark:
+        row, v, mask = trail.pop()
+        row[v] = mask
+
+
+def assign(row: List[int], v: int, bit: int, trail: list):
+    """Put the value with index `v` to the position `bit` of `row`, recording old masks on `trail`."""
+    for u, mask in enumerate(row):
+        if u != v and mask & bit:
+            trail.append((row, u, mask))
+            row[u] = mask & ~bit
+    if row[v] != bit:
+        trail.append((row, v, row[v]))
+        row[v] = bit
+
+
+class NogoodStore:
+    """Bounded store of nogoods: sets of (row index, position, value index) assignments proven inconsistent.
+
+    Nogoods are indexed by their assignments. When the store is full, the least recently useful nogood is
+    evicted."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.nogoods = collections.OrderedDict()  # frozenset of assignments -> None, least recently used first
+        self.index = collections.defaultdict(set)  # assignment -> nogoods containing it
+
+    def add(self, assignments):
+        nogood = frozenset(assignments)
+        if nogood in self.nogoods:
+            self.nogoods.move_to_end(nogood)
+            return
+        self.nogoods[nogood] = None
+        for assignment in nogood:
+            self.index[assignment].add(nogood)
+        while len(self.nogoods) > self.max_size:
+            evicted, _ = self.nogoods.popitem(last=False)
+            for assignment in evicted:
+                self.index[assignment].discard(evicted)
+
+    def blocks(self, domains: List[List[int]], assignment: Tuple[int, int, int]) -> bool:
+        """Whether `assignment` together with the values already placed in `domains` completes a nogood."""
+        for nogood in self.index.get(assignment, ()):
+            if all(domains[i][v] == 1 << j for i, j, v in nogood if (i, j, v) != assignment):
+                self.nogoods.move_to_end(nogood)
+                return True
+        return False
+
+
+def backtrack(domains: List[List[int]], propagator: Propagator,
+              value_degrees: Union[List[List[int]], None] = None, nogoods: Union[NogoodStore, None] = None,
+              budget: Union[Budget, None] = None, answer: Union[List[List[int]], None] = None):
+    """Depth-first search over propagated `domains` that yields every solved state.
+
+    The search mutates `domains` in place and undoes the changes of a branch from a trail instead of copying
+    domains, so a yielded state is only valid until the next one is requested (copy it to keep it).
+    Domains are restored when the search ends or the generator is closed.
+    With `nogoods`, the assignments of every branch that fails propagation or has no solutions in its subtree
+    are recorded, and a branch that completes a recorded nogood is skipped without propagation.
+    The search stops early once `budget` is exhausted. With `answer` (the value index at every position of
+    every row), the value of the answer is tried last at every branch, so solutions that differ from it come
+    first."""
+    trail = []
+    frames = []  # [row index, position bit, candidate values, next candidate, trail mark, solutions before]
+    n_found = 0
+    root = [row.copy() for row in domains] if nogoods is not None else None
+    stats = propagator.stats
+    stats.peak_grids = max(stats.peak_grids, 1 if root is None else 2)
+    consistent = True
+    try:
+        while True:
+            status = domains_status(domains) if consistent else False
+            if status is None:
+                i, j, candidates = select_cell(domains, value_degrees)
+                if answer is not None:
+                    candidates.sort(key=lambda v: v == answer[i][j])
+                frames.append([i, 1 << j, candidates, 0, len(trail), n_found])
+                stats.max_depth = max(stats.max_depth, len(frames))
+            elif status:
+                n_found += 1
+                yield domains
+            # go to the next untried branch
+            consistent = False
+            while frames and not consistent:
+                frame = frames[-1]
+                i, bit, candidates, k, mark, found_before = frame
+                undo(trail, mark)
+                if k == len(candidates):
+                    frames.pop()
+                    if nogoods is not None and frames and n_found == found_before:
+                        nogoods.add(_decisions(frames))
+                    continue
+                frame[3] = k + 1
+                if nogoods is not None:
+                    if nogoods.blocks(domains, (i, bit.bit_length() - 1, candidates[k])):
+                        propagator.stats.nogood_prunes += 1
+                        continue
+                if budget is not None and budget.spend():
+                    return
+                assign(domains[i], candidates[k], bit, trail)
+                consistent = propagator.propagate(domains, [i], trail)
+                if not consistent and nogoods is not None:
+                    nogoods.add(_shrink_nogood(root, propagator, _decisions(frames)))
+            if not consistent:
+                break
+    finally:
+        undo(trail, 0)
+
+
+def _shrink_nogood(root: List[List[int]], propagator: Propagator,
+                   decisions: List[Tuple[int, int, int]]) -> List[Tuple[int, int, int]]:
+    """Drop the decisions that are not needed for propagation from `root` to fail (the last one is kept).
+
+    The trial propagations run on a copy of `propagator` with its own counters, so they do not change the
+    revision order or the statistics of the search."""
+    side = Propagator(propagator.relations, len(root), None, 'matching' if propagator.matching else 'singles')
+    side.pruned = list(propagator.pruned)
+    needed = list(decisions)
+    for k in range(len(needed) - 2, -1, -1):
+        candidate = needed[:k] + needed[k + 1:]
+        domains = [row.copy() for row in root]
+        for i, j, v in candidate:
+            row = domains[i]
+            for u in range(len(row)):
+                row[u] &= ~(1 << j)
+            row[v] = root[i][v] & 1 << j
+        if not side.propagate(domains, sorted({i for i, _, _ in candidate})):
+            needed = candidate
+    return needed
+
+
+def _decisions(frames) -> List[Tuple[int, int, int]]:
+    """(row index, position, value index) of the current branch of every frame of `backtrack`."""
+    return [(i, bit.bit_length() - 1, candidates[k - 1]) for i, bit, candidates, k, *_ in frames]
+
+
+def domains_status(domains: List[List[int]]) -> Union[bool, None]:
+    """False if some value or position has no candidates left, True if solved, None if still undecided."""
+    solved = True
+    for row in domains:
+        union = 0
+        for mask in row:
+            if not mask:
+                return False
+            union |= mask
+            if mask & (mask - 1):
+                solved = False
+        if union != (1 << len(row)) - 1:
+            return False
+    return True if solved else None
+
+
+def count_value_degrees(relations: List[Tuple[List[int], List[int], ...]], table: List[list]) -> List[List[int]]:
+    """The number of relations mentioning every value of every row."""
+    value_degrees = [[0] * len(words) for words in table]
+    for ins, vns, *_ in relations:
+        for i, vn in zip(ins, vns):
+            value_degrees[i][vn] += 1
+    return value_degrees
+
+
+def select_cell(domains: List[List[int]], value_degrees: Union[List[List[int]], None] = None):
+    """Choose a position to branch on, returns (row index, position, candidate values) or None if solved.
+
+    Without `value_degrees` it is the first unresolved position of the first unresolved row. With
+    `value_degrees` (the number of relations mentioning every value) it is the position with the fewest
+    candidate values (minimum remaining values), ties are broken by the most constrained candidates."""
+    best, best_key = None, None
+    for i, row in enumerate(domains):
+        for j in range(len(row)):
+            bit = 1 << j
+            candidates = [v for v, mask in enumerate(row) if mask & bit]
+            if len(candidates) > 1:
+                if value_degrees is None:
+                    return i, j, candidates
+                key = (len(candidates), -sum(value_degrees[i][v] for v in candidates))
+                if best_key is None or key < best_key:
+                    best, best_key = (i, j, candidates), key
+    return best
+
+
+def domains_to_ranges(table: List[List[str]], domains: List[List[int]]) -> List[List[Set[str]]]:
+    return [[{word for word, mask in zip(words, row) if mask >> j & 1} for j in range(len(words))]
+            for words, row in zip(table, domains)]
+
+
 def solve_puzzle(table: List[List[str]],
                  relations: List[Union[Tuple[List[int], List[str], Union[Callable, Set[Callable], List[Callable]]],
                                        Tuple[List[int], List[str], Union[Callable, Set[Callable], List[Callable]], ...]]],
                  *,
                  allow_complex=True,
-                 max_solutions: Union[bool, None] = None) -> Tuple[bool, List[List[List[set]]], bool]:
+                 max_solutions: Union[bool, None] = None,
+                 engine: Literal['bitset', 'sets', 'dlx'] = 'bitset',
+                 search: Literal['bfs', 'dfs'] = 'bfs',
+                 max_nogoods: int = 0,
+                 alldifferent: Literal['singles', 'matching'] = 'singles',
+                 workers: int = 1,
+                 max_seconds: Union[float, None] = None,
+                 max_nodes: Union[int, None] = None,
+                 cancel: Union[Callable[[], bool], None] = None,
+                 stats: SolverStats = None) -> Tuple[Union[bool, None], List[List[List[set]]], bool]:
+    """Solve a grid puzzle, returns (status of ranges, ranges, is_complex_task).
+
+    `engine='bitset'` interns every value of a row to its index and keeps the domain of a value as a bitmask
+    of possible positions, `engine='sets'` is the original engine working with sets of words per cell.
+    `engine='dlx'` propagates like the bitset engine, but solves complex tasks as exact cover problems with
+    Algorithm X and dancing links (see `dancing_links`), so it returns the same result.
+    All engines return ranges as lists of sets of words.
+    The bitset engine propagates with a worklist. If `stats` is given, every engine adds its counters to it:
+    propagation passes and revisions, evaluated relation entries, candidates pruned per relation index, search
+    nodes, the deepest queue or stack, the most grids alive at once and the time spent propagating and searching
+    (see `SolverStats`, `dataclasses.asdict(stats)` exports them).
+    Every row is an all-different constraint: `alldifferent='singles'` filters it by naked and hidden singles,
+    `alldifferent='matching'` (not with engine='sets') removes every position that no perfect matching of
+    the row uses, so Hall sets are found before any branching.
+
+    `search='bfs'` explores complex tasks breadth-first, branching on the first unresolved position.
+    `search='dfs'` (engine='bitset' only) goes depth-first and branches on the position with the fewest
+    candidate values. It works on one set of domains and undoes branches from a trail, so only found
+    solutions are copied. With `max_nogoods` > 0 it also learns up to that many nogoods (assignments that
+    propagation or an exhausted subtree proved inconsistent) and skips branches that repeat them.
+
+    With `workers` > 1 (not with engine='sets') the branches of a complex task are searched by a pool of that
+    many processes, see `parallel_solutions`. Relations may be lambdas, they are compiled before they are
+    sent to the workers.
+
+    The search of a complex task is bounded by `max_seconds`, `max_nodes` (branches tried) and a `cancel`
+    callback that returns True to stop it, see `Budget`. When a limit is hit, the status is None (budget
+    exhausted) and the ranges are the solutions found so far followed by the propagated ranges the search
+    started from."""
+    if engine not in ('bitset', 'sets', 'dlx'):
+        raise ValueError("engine must be 'bitset', 'sets' or 'dlx'")
+    if search not in ('bfs', 'dfs'):
+        raise ValueError("search must be 'bfs' or 'dfs'")
+    if engine != 'bitset' and search != 'bfs':
+        raise ValueError("search='dfs' needs engine='bitset'")
+    if max_nogoods and search != 'dfs':
+        raise ValueError("max_nogoods needs search='dfs'")
+    if alldifferent not in ('singles', 'matching'):
+        raise ValueError("alldifferent must be 'singles' or 'matching'")
+    if engine == 'sets' and alldifferent != 'singles':
+        raise ValueError("engine='sets' supports only alldifferent='singles'")
+    if workers < 1:
+        raise ValueError('workers must be >= 1')
+    if engine == 'sets' and workers > 1:
+        raise ValueError("engine='sets' supports only workers=1")
 
     if max_solutions is not None and max_solutions <= 0:
         return False, [], False
 
-    new_relations = list()
-    for ins, wns, callable_object, *other in relations:
-        if callable(callable_object):
-            callable_object = {callable_object}
-        if callable_object:
-            objs = frozenset(callable_object)
-            new_relations.append((ins, wns,
-                                  lambda *c, objs=objs: all(callable_object(*c) for callable_object in objs),
-                                  *other))
-    relations = new_relations
+    # indices of the relations that are kept by `_normalize_relations`, `stats.relation_prunes` uses them
+    relation_indices = [k for k, (_, _, objs, *_) in enumerate(relations) if callable(objs) or objs]
+    relations = _normalize_relations(relations)
+    budget = Budget(max_seconds, max_nodes, cancel)
+    if engine in ('bitset', 'dlx'):
+        return _solve_puzzle_bitset(table, relations, allow_complex=allow_complex, max_solutions=max_solutions,
+                                    search='dlx' if engine == 'dlx' else search, max_nogoods=max_nogoods,
+                                    alldifferent=alldifferent, workers=workers, stats=stats, budget=budget,
+                                    relation_indices=relation_indices)
+
+    def holds(objs):
+        def all_hold(*c):
+            if stats is not None:
+                stats.evaluations += 1
+            return all(callable_object(*c) for callable_object in objs)
+        return all_hold
+
+    relations = [(ins, wns, holds(objs), *other) for ins, wns, objs, *other in relations]
 
     ranges = [[set(table[i]) for _ in range(len(table[i]))] for i in range(len(table))]
     changed = True
     while changed:
-        changed = update_ranges(relations, ranges)
+        changed = update_ranges(relations, ranges, stats, relation_indices)
 
     # check for 'no solutions'
     no_solutions = False
@@ -111,9 +1028,10 @@ def solve_puzzle(table: List[List[str]],
         return True, [ranges], False  # status of ranges, ranges, is_complex_task
 
     # if complex task, then algorithm will find all possible solutions
+    start = time.perf_counter()
     q = collections.deque([ranges])
     possible_solutions = []
-    while q:
+    while q and not budget.exhausted:
         current_ranges = q.popleft()
 
         # check for 'no solutions' and 'solved'
@@ -145,23 +1063,951 @@ def solve_puzzle(table: List[List[str]],
                 if len(rs) > 1:
                     founded = True
                     for r in rs:
+                        if budget.spend():
+                            break
                         new_ranges = [[x.copy() for x in row] for row in current_ranges]
                         new_ranges[n_group][n_x] = {r}
                         changed = True
                         while changed:
-                            changed = update_ranges(relations, new_ranges)
+                            changed = update_ranges(relations, new_ranges, stats, relation_indices)
                         q.append(new_ranges)
+                        if stats is not None:
+                            stats.max_depth = max(stats.max_depth, len(q))
+                            stats.peak_grids = max(stats.peak_grids, len(q) + 1)
                     break
             # if one group contained uncertainties, then other groups will be considered in ranges appended in q
             if founded:
                 break
+    if stats is not None:
+        stats.nodes += budget.nodes
+        stats.search_seconds += time.perf_counter() - start
 
+    if budget.exhausted:
+        return None, possible_solutions + [ranges], True  # status of ranges, ranges, is_complex_task
     if possible_solutions:
         return True, possible_solutions, True  # status of ranges, ranges, is_complex_task
     else:
         return False, [ranges], True  # status of ranges, ranges, is_complex_task
 
 
+def _normalize_relations(relations):
+    """Relations with a frozenset of callables each, relations without callables are dropped."""
+    new_relations = list()
+    for ins, wns, callable_object, *other in relations:
+        if callable(callable_object):
+            callable_object = {callable_object}
+        if callable_object:
+            new_relations.append((ins, wns, frozenset(callable_object), *other))
+    return new_relations
+
+
+def compile_relations(table: List[List[str]], relations,
+                      stats: SolverStats = None) -> List[Tuple[List[int], List[int], Union[int, tuple], ...]]:
+    """Replace words by value indices and callables by their `compile_table` for the bitset engine, truth
+    table entries that are not cached yet are counted as `stats.evaluations` if `stats` is given."""
+    value_indices = [{word: v for v, word in enumerate(words)} for words in table]
+    compiled = []
+    for ins, wns, objs, *other in relations:
+        misses = _truth_table_misses
+        compiled_table = compile_table(objs, len(ins), len(table[ins[0]]))
+        if stats is not None and _truth_table_misses > misses:
+            stats.evaluations += len(table[ins[0]]) ** len(ins)
+        compiled.append((ins, [value_indices[i][wn] for i, wn in zip(ins, wns)], compiled_table, *other))
+    return compiled
+
+
+def solution_key(domains: List[List[int]]) -> Tuple[Tuple[int, ...], ...]:
+    """Hashable canonical form of solved domains: the position of every value of every row."""
+    return tuple(tuple(mask.bit_length() - 1 for mask in row) for row in domains)
+
+
+def breadth_first(domains: List[List[int]], propagator: Propagator, budget: Union[Budget, None] = None):
+    """Breadth-first search over propagated `domains` that yields every solved state, it branches on the first
+    unresolved position of the first unresolved row and keeps a copy of the domains per queued state.
+    The search stops early once `budget` is exhausted."""
+    q = collections.deque([domains])
+    while q:
+        current_domains = q.popleft()
+
+        status = domains_status(current_domains)
+        if status is False:
+            continue
+        if status:
+            yield current_domains
+            continue
+
+        # generate new domains: the first position of the first row that has several candidate values
+        n_group, n_x, candidates = select_cell(current_domains)
+        bit = 1 << n_x
+        for v in candidates:
+            if budget is not None and budget.spend():
+                return
+            new_domains = [r.copy() for r in current_domains]
+            new_row = new_domains[n_group]
+            for u in candidates:
+                new_row[u] &= ~bit
+            new_row[v] = bit
+            if propagator.propagate(new_domains, [n_group]):
+                q.append(new_domains)
+                propagator.stats.max_depth = max(propagator.stats.max_depth, len(q))
+                propagator.stats.peak_grids = max(propagator.stats.peak_grids, len(q) + 1)
+
+
+class DancingLinks:
+    """Exact cover matrix for Knuth's Algorithm X with dancing links.
+
+    Node 0 is the root, nodes 1..n_items are the item headers and every option adds one node per item it
+    covers. Removed nodes keep their own links, so every removal is undone by relinking in reverse order."""
+
+    def __init__(self, n_items: int, options: List[List[int]]):
+        self.left = [n_items] + list(range(n_items))
+        self.right = list(range(1, n_items + 1)) + [0]
+        self.up = list(range(n_items + 1))
+        self.down = list(range(n_items + 1))
+        self.item = list(range(n_items + 1))
+        self.option = [-1] * (n_items + 1)
+        self.size = [0] * (n_items + 1)
+        self.first_nodes = []  # option -> its first node
+        for o, items in enumerate(options):
+            first = len(self.item)
+            self.first_nodes.append(first)
+            for k, item in enumerate(items):
+                node = first + k
+                header = item + 1
+                self.left.append(first + (k - 1) % len(items))
+                self.right.append(first + (k + 1) % len(items))
+                self.up.append(self.up[header])
+                self.down.append(header)
+                self.down[self.up[header]] = node
+                self.up[header] = node
+                self.item.append(header)
+                self.option.append(o)
+                self.size[header] += 1
+
+    def cover(self, header: int):
+        """Remove item `header` and every option that covers it from the other items."""
+        left, right, up, down, item, size = self.left, self.right, self.up, self.down, self.item, self.size
+        right[left[header]], left[right[header]] = right[header], left[header]
+        node = down[header]
+        while node != header:
+            other = right[node]
+            while other != node:
+                up[down[other]], down[up[other]] = up[other], down[other]
+                size[item[other]] -= 1
+                other = right[other]
+            node = down[node]
+
+    def uncover(self, header: int):
+        """Undo `cover(header)`."""
+        left, right, up, down, item, size = self.left, self.right, self.up, self.down, self.item, self.size
+        node = up[header]
+        while node != header:
+            other = left[node]
+            while other != node:
+                up[down[other]] = down[up[other]] = other
+                size[item[other]] += 1
+                other = left[other]
+            node = up[node]
+        right[left[header]] = left[right[header]] = header
+
+    def hide(self, o: int, removed: List[int]):
+        """Remove the still linked nodes of option `o` from their items, appending them to `removed`."""
+        up, down, item, size = self.up, self.down, self.item, self.size
+        node = first = self.first_nodes[o]
+        while True:
+            if down[up[node]] == node:
+                up[down[node]], down[up[node]] = up[node], down[node]
+                size[item[node]] -= 1
+                removed.append(node)
+            node = self.right[node]
+            if node == first:
+                break
+
+    def unhide(self, removed: List[int], mark: int):
+        """Relink the nodes removed by `hide` after the first `mark` entries of `removed`."""
+        up, down, item, size = self.up, self.down, self.item, self.size
+        while len(removed) > mark:
+            node = removed.pop()
+            up[down[node]] = down[up[node]] = node
+            size[item[node]] += 1
+
+
+def dancing_links(domains: List[List[int]], propagator: Propagator, budget: Union[Budget, None] = None):
+    """Algorithm X over propagated `domains` that yields every solved state.
+
+    Every row is an exact cover problem: each value takes one position and each position one value, the
+    options are the (value, position) pairs left in `domains`. Relations filter partial covers: once all but
+    one of the values of a relation are placed, the options of the last value that the relation does not
+    support are hidden, and a relation with all its values placed must hold. The search stops early once
+    `budget` is exhausted."""
+    n_rows, m_objects = len(domains), len(domains[0])
+    relations = propagator.relations
+    # items: value v of row i is i * m + v, position p of row i is (n + i) * m + p
+    options, option_cells, option_ids = [], [], {}
+    for i, row in enumerate(domains):
+        for v, mask in enumerate(row):
+            while mask:
+                bit = mask & -mask
+                mask ^= bit
+                p = bit.bit_length() - 1
+                option_ids[i, v, p] = len(options)
+                options.append([i * m_objects + v, (n_rows + i) * m_objects + p])
+                option_cells.append((i, v, p))
+    links = DancingLinks(2 * n_rows * m_objects, options)
+    watchers = collections.defaultdict(list)
+    for r, (ins, vns, *_) in enumerate(relations):
+        for i, vn in sorted(set(zip(ins, vns))):
+            watchers[i, vn].append(r)
+    position_of = [[-1] * m_objects for _ in range(n_rows)]
+    removed = []
+    left, right, down, size, option = links.left, links.right, links.down, links.size, links.option
+
+    def forward_check(i, v) -> bool:
+        for r in watchers[i, v]:
+            ins, vns, table, *_ = relations[r]
+            free = {(i2, vn) for i2, vn in zip(ins, vns) if position_of[i2][vn] < 0}
+            if len(free) > 1:
+                continue
+            supports = relation_supports(table, [domains[i2][vn] if position_of[i2][vn] < 0
+                                                 else 1 << position_of[i2][vn] for i2, vn in zip(ins, vns)])
+            if not all(supports):
+                return False
+            for (i2, vn), support in zip(zip(ins, vns), supports):
+                if (i2, vn) in free:
+                    mask = domains[i2][vn] & ~support
+                    while mask:
+                        bit = mask & -mask
+                        mask ^= bit
+                        links.hide(option_ids[i2, vn, bit.bit_length() - 1], removed)
+        return True
+
+    def select(node: int):
+        """Cover the other items of the option of `node`."""
+        other = right[node]
+        while other != node:
+            links.cover(links.item[other])
+            other = right[other]
+
+    def deselect(node: int):
+        other = left[node]
+        while other != node:
+            links.uncover(links.item[other])
+            other = left[other]
+
+    def search(depth):
+        propagator.stats.max_depth = max(propagator.stats.max_depth, depth)
+        if right[0] == 0:
+            yield [[1 << position_of[i][v] for v in range(m_objects)] for i in range(n_rows)]
+            return
+        # the item with the fewest options left
+        header, best = right[0], None
+        while header != 0:
+            if best is None or size[header] < size[best]:
+                best = header
+                if not size[header]:
+                    break
+            header = right[header]
+        if not size[best]:
+            return
+        links.cover(best)
+        node = down[best]
+        while node != best:
+            if budget is not None and budget.spend():
+                break
+            i, v, p = option_cells[option[node]]
+            select(node)
+            position_of[i][v] = p
+            mark = len(removed)
+            if forward_check(i, v):
+                yield from search(depth + 1)
+            links.unhide(removed, mark)
+            position_of[i][v] = -1
+            deselect(node)
+            node = down[node]
+        links.uncover(best)
+
+    propagator.stats.peak_grids = max(propagator.stats.peak_grids, 1)
+    yield from search(0)
+
+
+def search_solutions(domains: List[List[int]], propagator: Propagator, search: Literal['bfs', 'dfs', 'dlx'],
+                     value_degrees: Union[List[List[int]], None] = None, nogoods: Union[NogoodStore, None] = None,
+                     budget: Union[Budget, None] = None):
+    """Yield every distinct solved state below propagated `domains`, de-duplicated by `solution_key`."""
+    seen = set()
+    if search == 'dfs':
+        states = backtrack(domains, propagator, value_degrees, nogoods, budget)
+    elif search == 'dlx':
+        states = dancing_links(domains, propagator, budget)
+    else:
+        states = breadth_first(domains, propagator, budget)
+    try:
+        for solved in states:
+            key = solution_key(solved)
+            if key not in seen:
+                seen.add(key)
+                yield solved
+    finally:
+        states.close()
+
+
+def split_branches(domains: List[List[int]], propagator: Propagator, n_branches: int):
+    """Split propagated `domains` breadth-first at the cells with the fewest candidates until there are at least
+    `n_branches` open branches, returns (solved states, open branches). The branches do not overlap."""
+    value_degrees = count_value_degrees(propagator.relations, domains)
+    solved, branches = [], collections.deque([domains])
+    while branches and len(branches) < n_branches:
+        current_domains = branches.popleft()
+        n_group, n_x, candidates = select_cell(current_domains, value_degrees)
+        bit = 1 << n_x
+        for v in candidates:
+            new_domains = [r.copy() for r in current_domains]
+            new_row = new_domains[n_group]
+            for u in candidates:
+                new_row[u] &= ~bit
+            new_row[v] = bit
+            if propagator.propagate(new_domains, [n_group]):
+                # a position left without values is a contradiction too
+                status = domains_status(new_domains)
+                if status:
+                    solved.append(new_domains)
+                elif status is None:
+                    branches.append(new_domains)
+    return solved, list(branches)
+
+
+_cancelled = None  # the event of a pool worker that asks it to stop, see `parallel_solutions`
+_nodes = None  # the number of search nodes of all pool workers, see `parallel_solutions`
+
+
+def _init_worker(cancelled, nodes):
+    global _cancelled, _nodes
+    _cancelled, _nodes = cancelled, nodes
+
+
+class _SharedBudget(Budget):
+    """A `Budget` of a pool worker whose node limit applies to the nodes of all workers in `shared_nodes`."""
+
+    def __init__(self, shared_nodes, max_nodes: Union[int, None] = None,
+                 cancel: Union[Callable[[], bool], None] = None):
+        super().__init__(max_nodes=max_nodes, cancel=cancel)
+        self.shared_nodes = shared_nodes
+
+    def spend(self, nodes: int = 1) -> bool:
+        with self.shared_nodes.get_lock():
+            # once the workers together went over the limit, later nodes are not started, so not counted
+            if self.max_nodes is not None and self.shared_nodes.value > self.max_nodes:
+                self.exhausted = True
+                nodes = 0
+            self.shared_nodes.value += nodes
+        return super().spend(nodes)
+
+
+def _solve_branch(relations, domains, search, max_nogoods, alldifferent, max_solutions, max_nodes):
+    """Solutions below one branch, the counters of the search and whether its node budget ran out, run in
+    a pool worker."""
+    stats = SolverStats()
+    propagator = Propagator(relations, len(domains), stats, alldifferent)
+    value_degrees = count_value_degrees(relations, domains) if search == 'dfs' else None
+    nogoods = NogoodStore(max_nogoods) if max_nogoods else None
+    cancel = _cancelled.is_set if _cancelled is not None else None
+    budget = _SharedBudget(_nodes, max_nodes, cancel) if _nodes is not None else Budget(max_nodes=max_nodes,
+                                                                                         cancel=cancel)
+    found = []
+    solutions = search_solutions(domains, propagator, search, value_degrees, nogoods, budget)
+    for solved in solutions:
+        found.append([row.copy() for row in solved])
+        if max_solutions is not None and len(found) >= max_solutions:
+            break
+    solutions.close()
+    stats.nodes += budget.nodes
+    return found, stats, budget.exhausted and not budget.cancel(), propagator.pruned
+
+
+def parallel_solutions(domains: List[List[int]], propagator: Propagator, search: Literal['bfs', 'dfs', 'dlx'],
+                       workers: int, max_nogoods: int = 0, max_solutions: Union[int, None] = None,
+                       budget: Union[Budget, None] = None):
+    """Distinct solved states below propagated `domains`, searched by `workers` processes.
+
+    The tree is split into about four branches per worker, so a pool worker that finishes a small branch
+    takes the next one. Compiled relations hold truth tables or relation kinds instead of lambdas, so they
+    are pickled to the workers as they are. Once `max_solutions` are found, or `budget` runs out of time or
+    is cancelled, pending branches are cancelled and running workers stop at their next node. The node limit
+    of `budget` applies to the nodes of all workers together. Solutions are merged in the order of their
+    branches."""
+    solved, branches = split_branches(domains, propagator, 4 * workers)
+    results = [None] * len(branches)
+    n_found = len(solved)
+    if branches and (max_solutions is None or n_found < max_solutions):
+        alldifferent = 'matching' if propagator.matching else 'singles'
+        context = multiprocessing.get_context()
+        cancelled = context.Event()
+        max_nodes = budget.max_nodes if budget is not None else None
+        # the workers count their nodes together, starting from the nodes already spent
+        nodes = context.Value('q', budget.nodes if budget is not None else 0)
+        executor = concurrent.futures.ProcessPoolExecutor(workers, mp_context=context,
+                                                          initializer=_init_worker, initargs=(cancelled, nodes))
+        futures = {}
+        try:
+            for k, branch in enumerate(branches):
+                futures[executor.submit(_solve_branch, propagator.relations, branch, search, max_nogoods,
+                                        alldifferent, max_solutions, max_nodes)] = k
+            pending = set(futures)
+            while pending and not cancelled.is_set():
+                # without a budget there is nothing to poll, so wait for the next branch
+                done, pending = concurrent.futures.wait(pending, timeout=None if budget is None else 0.05,
+                                                        return_when=concurrent.futures.FIRST_COMPLETED)
+                n_found += sum(len(future.result()[0]) for future in done)
+                if max_nodes is not None and nodes.value > max_nodes:
+                    budget.exhausted = True
+                if max_solutions is not None and n_found >= max_solutions or budget is not None and budget.spend(0):
+                    cancelled.set()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+        if max_nodes is not None and nodes.value > max_nodes:
+            budget.exhausted = True
+        # branches that were running when the search was stopped still return what they found
+        for future, k in futures.items():
+            if future.done() and not future.cancelled():
+                results[k], stats, exhausted, pruned = future.result()
+                propagator.stats.add(stats)
+                for r, n_pruned in enumerate(pruned):
+                    propagator.pruned[r] += n_pruned
+                if exhausted:
+                    budget.exhausted = True
+
+    seen = set()
+    possible_solutions = []
+    for solutions in [solved, *results]:
+        for solution in solutions or []:
+            key = solution_key(solution)
+            if key not in seen:
+                seen.add(key)
+                possible_solutions.append(solution)
+    return possible_solutions[:max_solutions]
+
+
+def iter_solutions(table: List[List[str]],
+                   relations: List[Union[Tuple[List[int], List[str], Union[Callable, Set[Callable], List[Callable]]],
+                                         Tuple[List[int], List[str], Union[Callable, Set[Callable], List[Callable]], ...]]],
+                   *,
+                   search: Literal['bfs', 'dfs'] = 'dfs',
+                   max_nogoods: int = 0,
+                   alldifferent: Literal['singles', 'matching'] = 'singles',
+                   stats: SolverStats = None):
+    """Yield every solution of a grid puzzle as ranges (lists of sets of words) as soon as it is found.
+
+    Unlike `solve_puzzle`, nothing is collected: the search goes on only while the caller asks for the next
+    solution, so closing the generator (or breaking out of a loop over it) stops the work.
+    `search`, `max_nogoods` and `alldifferent` are the same as in `solve_puzzle`."""
+    if search not in ('bfs', 'dfs'):
+        raise ValueError("search must be 'bfs' or 'dfs'")
+    if max_nogoods and search != 'dfs':
+        raise ValueError("max_nogoods needs search='dfs'")
+    relations = compile_relations(table, _normalize_relations(relations))
+    propagator = Propagator(relations, len(table), stats, alldifferent)
+    value_degrees = count_value_degrees(relations, table) if search == 'dfs' else None
+
+    domains = [[(1 << len(words)) - 1] * len(words) for words in table]
+    if not propagator.propagate(domains):
+        return
+    nogoods = NogoodStore(max_nogoods) if max_nogoods else None
+    solutions = search_solutions(domains, propagator, search, value_degrees, nogoods)
+    try:
+        for solved in solutions:
+            yield domains_to_ranges(table, solved)
+    finally:
+        solutions.close()
+
+
+def count_row_permutations(row: List[int], max_count: Union[int, None] = None) -> int:
+    """The number of ways to give every value of `row` its own position within its bitmask."""
+    states = {0: 1}  # positions taken by the first values -> number of ways
+    for mask in row:
+        new_states = collections.defaultdict(int)
+        for taken, n_ways in states.items():
+            free = mask & ~taken
+            while free:
+                bit = free & -free
+                free ^= bit
+                new_states[taken | bit] += n_ways
+        states = new_states
+    n_ways = sum(states.values())
+    return n_ways if max_count is None else min(n_ways, max_count)
+
+
+def count_domain_solutions(domains: List[List[int]], propagator: Propagator,
+                           max_count: Union[int, None] = None, budget: Union[Budget, None] = None) -> int:
+    """The number of solutions of propagated `domains`, counting stops at `max_count`. If `budget` is
+    exhausted, counting stops too and the result is only a lower bound.
+
+    The search branches on the positions of values mentioned by relations. Once all of them are placed,
+    the relations are decided and the remaining rows are independent permutations, which are counted row by
+    row and multiplied instead of being enumerated."""
+    mentioned = [[False] * len(row) for row in domains]
+    for ins, vns, *_ in propagator.relations:
+        for i, vn in zip(ins, vns):
+            mentioned[i][vn] = True
+    count = 0
+    trail = []
+
+    def visit(depth):
+        nonlocal count
+        propagator.stats.max_depth = max(propagator.stats.max_depth, depth)
+        best = None
+        for i, row in enumerate(domains):
+            for v, mask in enumerate(row):
+                if mentioned[i][v] and mask & (mask - 1):
+                    if best is None or mask.bit_count() < best[2].bit_count():
+                        best = (i, v, mask)
+        if best is None:
+            n_ways = 1
+            for row in domains:
+                n_ways *= count_row_permutations(row)
+                if not n_ways:
+                    break
+            count += n_ways
+            return
+        i, v, mask = best
+        while mask and (max_count is None or count < max_count):
+            if budget is not None and budget.spend():
+                break
+            bit = mask & -mask
+            mask ^= bit
+            mark = len(trail)
+            assign(domains[i], v, bit, trail)
+            if propagator.propagate(domains, [i], trail):
+                visit(depth + 1)
+            undo(trail, mark)
+
+    propagator.stats.peak_grids = max(propagator.stats.peak_grids, 1)
+    visit(0)
+    return count if max_count is None else min(count, max_count)
+
+
+def count_solutions(table: List[List[str]],
+                    relations: List[Union[Tuple[List[int], List[str], Union[Callable, Set[Callable], List[Callable]]],
+                                          Tuple[List[int], List[str], Union[Callable, Set[Callable], List[Callable]], ...]]],
+                    *,
+                    max_count: Union[int, None] = None,
+                    alldifferent: Literal['singles', 'matching'] = 'singles',
+                    max_seconds: Union[float, None] = None,
+                    max_nodes: Union[int, None] = None,
+                    cancel: Union[Callable[[], bool], None] = None,
+                    stats: SolverStats = None) -> Union[int, None]:
+    """The number of solutions of a grid puzzle without building them, at most `max_count` if it is given
+    (`max_count=2` tells 0, 1 and "2 or more" apart).
+
+    Rows that are not linked by relations form independent sub-grids, they are counted one by one and the
+    counts are multiplied. `alldifferent`, `max_seconds`, `max_nodes` and `cancel` are the same as in
+    `solve_puzzle`, None is returned if the budget is exhausted before the count is known."""
+    if max_count is not None and max_count <= 0:
+        return 0
+    relations = compile_relations(table, _normalize_relations(relations), stats)
+    domains = [[(1 << len(words)) - 1] * len(words) for words in table]
+    if not Propagator(relations, len(table), stats, alldifferent).propagate(domains):
+        return 0
+
+    # sub-grids: rows linked by relations
+    parents = list(range(len(table)))
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    for ins, *_ in relations:
+        for i in ins[1:]:
+            parents[find(i)] = find(ins[0])
+    groups = collections.defaultdict(list)
+    for i in range(len(table)):
+        groups[find(i)].append(i)
+
+    budget = Budget(max_seconds, max_nodes, cancel)
+    counts = []
+    for rows in groups.values():
+        local = {i: k for k, i in enumerate(rows)}
+        sub_relations = [([local[i] for i in ins], vns, *other) for ins, vns, *other in relations if ins[0] in local]
+        sub_domains = [domains[i] for i in rows]
+        nodes, start = budget.nodes, time.perf_counter()
+        n_ways = count_domain_solutions(sub_domains, Propagator(sub_relations, len(rows), stats, alldifferent),
+                                        max_count, budget)
+        if stats is not None:
+            stats.nodes += budget.nodes - nodes
+            stats.search_seconds += time.perf_counter() - start
+        if budget.exhausted:
+            return None
+        if not n_ways:
+            return 0
+        counts.append(n_ways)
+    n_ways = 1
+    for count in counts:
+        n_ways *= count
+    return n_ways if max_count is None else min(n_ways, max_count)
+
+
+@functools.lru_cache(maxsize=1024)
+def _dense_table(callable_objects: FrozenSet[Callable], n_args: int, m_objects: int):
+    """The `truth_table` of a relation as a boolean numpy array with one axis per argument."""
+    def expand(table, depth):
+        if depth == n_args - 1:
+            return [bool(table >> j & 1) for j in range(m_objects)]
+        return [expand(sub_table, depth + 1) for sub_table in table]
+
+    dense = numpy.array(expand(truth_table(callable_objects, n_args, m_objects), 0), dtype=bool)
+    dense.flags.writeable = False
+    return dense
+
+
+def propagate_batch(tables: List[List[List[str]]], batch_relations: List[list]) -> List[List[List[int]]]:
+    """Propagate many puzzles of the same shape at once, returns the bitset domains of every puzzle.
+
+    The domains of all puzzles are one boolean array (puzzle x row x value x position). Every pass revises all
+    relations of all puzzles grouped by arity with their dense truth tables, then applies naked and hidden
+    singles to all rows, until nothing changes. For a puzzle without contradiction the fixpoint is the same as
+    `Propagator.propagate` reaches. A puzzle is no longer revised once the row filters find a contradiction,
+    all its masks are returned empty then."""
+    n_rows, m_objects = len(tables[0]), len(tables[0][0])
+    domains = numpy.ones((len(tables), n_rows, m_objects, m_objects), dtype=bool)
+    groups = collections.defaultdict(lambda: ([], [], [], []))  # arity -> puzzles, rows, values, tables
+    for b, (table, relations) in enumerate(zip(tables, batch_relations)):
+        value_indices = [{word: v for v, word in enumerate(words)} for words in table]
+        for ins, wns, objs, *_ in relations:
+            puzzles, rows, values, dense_tables = groups[len(ins)]
+            puzzles.append(b)
+            rows.append(ins)
+            values.append([value_indices[i][wn] for i, wn in zip(ins, wns)])
+            dense_tables.append(_dense_table(objs, len(ins), m_objects))
+    groups = [(numpy.array(puzzles), numpy.array(rows), numpy.array(values), numpy.stack(dense_tables))
+              for puzzles, rows, values, dense_tables in groups.values()]
+
+    active = numpy.ones(len(tables), dtype=bool)  # puzzles that changed in the last pass
+    failed = numpy.zeros(len(tables), dtype=bool)  # puzzles with an empty value or position
+    while True:
+        before = domains.copy()
+        for puzzles, rows, values, dense_tables in groups:
+            revised = active[puzzles]
+            if not revised.all():
+                puzzles, rows, values, dense_tables = (puzzles[revised], rows[revised], values[revised],
+                                                       dense_tables[revised])
+            n_args = rows.shape[1]
+            masks = [domains[puzzles, rows[:, k], values[:, k]] for k in range(n_args)]
+            admissible = dense_tables.copy()
+            for k, mask in enumerate(masks):
+                admissible &= mask.reshape((len(puzzles),) + (1,) * k + (m_objects,) + (1,) * (n_args - k - 1))
+            for k in range(n_args):
+                axes = tuple(a for a in range(1, n_args + 1) if a != k + 1)
+                support = admissible.any(axis=axes) if axes else admissible
+                numpy.logical_and.at(domains, (puzzles, rows[:, k], values[:, k]), support)
+        # hidden singles: a value that has only one position takes this position from other values
+        single = domains.sum(axis=3) == 1
+        taken = (domains & single[..., None]).any(axis=2)
+        domains &= ~taken[:, :, None, :] | single[..., None]
+        # naked singles: a position that only one value can take is given to that value
+        unique = domains & (domains.sum(axis=2) == 1)[:, :, None, :]
+        first_unique = unique & (numpy.cumsum(unique, axis=3) == 1)
+        domains = numpy.where(unique.any(axis=3)[..., None], first_unique, domains)
+        domains[failed] = before[failed]
+        # an empty value or position, or two values left with the same single position
+        single = domains.sum(axis=3) == 1
+        failed |= (~domains.any(axis=3).all(axis=(1, 2)) | ~domains.any(axis=2).all(axis=(1, 2))
+                   | ((domains & single[..., None]).sum(axis=2) > 1).any(axis=(1, 2)))
+        active = (before != domains).any(axis=(1, 2, 3)) & ~failed
+        if not active.any():
+            break
+    domains[failed] = False
+    weights = 1 << numpy.arange(m_objects, dtype=numpy.int64)
+    return (domains * weights).sum(axis=3).tolist()
+
+
+def solve_puzzles(puzzles: List[Tuple[List[List[str]], list]],
+                  *,
+                  allow_complex=True,
+                  max_solutions: Union[bool, None] = None,
+                  search: Literal['bfs', 'dfs'] = 'bfs',
+                  vectorized: Union[bool, None] = None) -> List[Tuple[bool, List[List[List[set]]], bool]]:
+    """Solve many (table, relations) puzzles, returns the `solve_puzzle` result of every puzzle.
+
+    With numpy (`vectorized=None` uses it if it is installed) puzzles of the same shape are propagated
+    together by `propagate_batch`, and only the puzzles that are still unresolved are searched one by one."""
+    if vectorized is None:
+        vectorized = numpy is not None
+    if vectorized and numpy is None:
+        raise ValueError('vectorized=True needs numpy')
+    if search not in ('bfs', 'dfs'):
+        raise ValueError("search must be 'bfs' or 'dfs'")
+    if max_solutions is not None and max_solutions <= 0:
+        return [(False, [], False) for _ in puzzles]
+
+    puzzles = [(table, _normalize_relations(relations)) for table, relations in puzzles]
+    roots = [None] * len(puzzles)
+    if vectorized:
+        shapes = collections.defaultdict(list)
+        for k, (table, relations) in enumerate(puzzles):
+            shapes[len(table), len(table[0])].append(k)
+        for indices in shapes.values():
+            batch = propagate_batch([puzzles[k][0] for k in indices], [puzzles[k][1] for k in indices])
+            for k, domains in zip(indices, batch):
+                # a contradictory puzzle is propagated again, so its ranges are the ones of `solve_puzzle`
+                roots[k] = domains if domains_status(domains) is not False else None
+    return [_solve_puzzle_bitset(table, relations, allow_complex=allow_complex, max_solutions=max_solutions,
+                                 search=search, max_nogoods=0, alldifferent='singles', workers=1, stats=None,
+                                 domains=domains)
+            for (table, relations), domains in zip(puzzles, roots)]
+
+
+def _solve_puzzle_bitset(table, relations, *, allow_complex, max_solutions, search, max_nogoods, alldifferent,
+                         workers, stats, budget=None, domains=None, relation_indices=None):
+    """`solve_puzzle` with the bitset engine, `domains` are the propagated root if it is already known.
+    `relation_indices` map `relations` to the indices of `stats.relation_prunes`."""
+    relations = compile_relations(table, relations, stats)
+    propagator = Propagator(relations, len(table), stats, alldifferent)
+    if budget is None:
+        budget = Budget()
+    try:
+        return _search_puzzle_bitset(table, propagator, allow_complex=allow_complex, max_solutions=max_solutions,
+                                     search=search, max_nogoods=max_nogoods, workers=workers, budget=budget,
+                                     domains=domains)
+    finally:
+        if stats is not None:
+            for r, n_pruned in enumerate(propagator.pruned):
+                if n_pruned:
+                    r = relation_indices[r] if relation_indices is not None else r
+                    stats.relation_prunes[r] = stats.relation_prunes.get(r, 0) + n_pruned
+
+
+def _search_puzzle_bitset(table, propagator, *, allow_complex, max_solutions, search, max_nogoods, workers, budget,
+                          domains):
+    """The propagation and search part of `_solve_puzzle_bitset`."""
+    relations = propagator.relations
+    value_degrees = count_value_degrees(relations, table) if search == 'dfs' else None
+
+    if domains is None:
+        domains = [[(1 << len(words)) - 1] * len(words) for words in table]
+        if not propagator.propagate(domains):
+            # a contradiction may stop propagation before it empties a mask
+            return False, [domains_to_ranges(table, domains)], False  # status of ranges, ranges, is_complex_task
+
+    status = domains_status(domains)
+    if status is False or not allow_complex:
+        return False, [domains_to_ranges(table, domains)], False  # status of ranges, ranges, is_complex_task
+    if status:
+        return True, [domains_to_ranges(table, domains)], False  # status of ranges, ranges, is_complex_task
+
+    # if complex task, then algorithm will find all possible solutions
+    start = time.perf_counter()
+    possible_solutions = []
+    if workers > 1:
+        possible_solutions = parallel_solutions(domains, propagator, search, workers, max_nogoods, max_solutions,
+                                                budget)
+    else:
+        nogoods = NogoodStore(max_nogoods) if max_nogoods else None
+        solutions = search_solutions(domains, propagator, search, value_degrees, nogoods, budget)
+        for solved in solutions:
+            possible_solutions.append([row.copy() for row in solved])
+            if max_solutions is not None and len(possible_solutions) >= max_solutions:
+                break
+        solutions.close()
+    propagator.stats.nodes += budget.nodes
+    propagator.stats.search_seconds += time.perf_counter() - start
+
+    if budget.exhausted:
+        # budget exhausted: the solutions found so far and the propagated domains the search started from
+        return None, [domains_to_ranges(table, s) for s in possible_solutions + [domains]], True
+    if possible_solutions:
+        return True, [domains_to_ranges(table, s) for s in possible_solutions], True
+    else:
+        return False, [domains_to_ranges(table, domains)], True  # status of ranges, ranges, is_complex_task
+
+
+def _code_names(code: types.CodeType) -> set:
+    """The global and attribute names used by `code` and the code objects nested in it."""
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _code_names(const)
+    return names
+
+
+def callable_descriptor(callable_object, _functions: tuple = ()) -> str:
+    """A description of a relation callable that is stable across processes and restarts.
+
+    Relation kinds are described by their fields, functions and lambdas by their byte code, constants,
+    default arguments, closure values and the values of the globals they read, so two lambdas written the
+    same way get the same descriptor, and `lambda c: c == X` gets another one once the global X changes."""
+    if isinstance(callable_object, RelationKind):
+        return repr(callable_object)
+    if isinstance(callable_object, types.FunctionType):
+        if callable_object in _functions:
+            # a function that reads itself, like a recursive one, is described by its name inside itself
+            return repr(('recursive', callable_object.__qualname__))
+        functions = _functions + (callable_object,)
+        closure = tuple(callable_descriptor(cell.cell_contents, functions)
+                        for cell in callable_object.__closure__ or ())
+        defaults = tuple(callable_descriptor(d, functions) for d in callable_object.__defaults__ or ())
+        kw_defaults = sorted((k, callable_descriptor(d, functions))
+                             for k, d in (callable_object.__kwdefaults__ or {}).items())
+        global_values = sorted((name, callable_descriptor(callable_object.__globals__[name], functions))
+                               for name in _code_names(callable_object.__code__)
+                               if name in callable_object.__globals__)
+        return repr(('function', callable_descriptor(callable_object.__code__), defaults, kw_defaults, closure,
+                     global_values))
+    if isinstance(callable_object, types.CodeType):
+        return repr(('code', callable_object.co_code, callable_object.co_names, callable_object.co_argcount,
+                     tuple(callable_descriptor(c) for c in callable_object.co_consts)))
+    if isinstance(callable_object, (tuple, list, set, frozenset)):
+        items = [callable_descriptor(item, _functions) for item in callable_object]
+        return repr((type(callable_object).__name__, items if isinstance(callable_object, (tuple, list))
+                     else sorted(items)))
+    return repr(callable_object)
+
+
+def canonical_key(table: List[List[str]], relations) -> Tuple[List[int], tuple]:
+    """Returns (row order, key): the key is the same for puzzles that differ only in the order of relations,
+    rows or words of a row, and row `order[k]` of `table` is row k of the canonical puzzle."""
+    rows = [tuple(sorted(words)) for words in table]
+    order = sorted(range(len(table)), key=lambda i: rows[i])
+    rank = {i: k for k, i in enumerate(order)}
+    relation_keys = []
+    for ins, wns, objs, *_ in _normalize_relations(relations):
+        relation_keys.append((tuple((rank[i], wn) for i, wn in zip(ins, wns)),
+                              tuple(sorted(callable_descriptor(callable_object) for callable_object in objs))))
+    return order, (tuple(rows[i] for i in order), tuple(sorted(relation_keys)))
+
+
+class SolveCache:
+    """`solve_puzzle` with memoized results.
+
+    Results are cached under `canonical_key`, so a puzzle that comes again with its relations, rows or words
+    in another order is solved once. The `max_size` most recently used results are kept in memory, with
+    `path` they are also kept in a `shelve` file that survives restarts. Results of an exhausted budget
+    (status None) are not cached."""
+
+    def __init__(self, max_size: int = 1024, path: Union[str, None] = None):
+        self.max_size = max_size
+        self.results = collections.OrderedDict()  # key -> canonical result, least recently used first
+        self.store = shelve.open(path) if path is not None else None
+        self.hits = 0
+        self.misses = 0
+
+    def solve(self, table: List[List[str]], relations,
+              **kwargs) -> Tuple[Union[bool, None], List[List[List[set]]], bool]:
+        """`solve_puzzle(table, relations, **kwargs)`, from the cache if the puzzle was solved before."""
+        order, key = canonical_key(table, relations)
+        # options that change the result: the matching filter narrows ranges, workers change the order of the
+        # solutions and which ones `max_solutions` keeps. Nogoods only skip failed branches, limits give
+        # status None and are not cached, stats are not part of the result.
+        key = key + tuple((name, kwargs.get(name, default)) for name, default in
+                          (('allow_complex', True), ('max_solutions', None), ('engine', 'bitset'), ('search', 'bfs'),
+                           ('alldifferent', 'singles'), ('workers', 1)))
+        rank = {i: k for k, i in enumerate(order)}
+        result = self._get(key)
+        if result is None:
+            self.misses += 1
+            status, ranges, is_complex_task = solve_puzzle(table, relations, **kwargs)
+            if status is None:
+                return status, ranges, is_complex_task
+            result = (status, [tuple(tuple(frozenset(cell) for cell in grid[i]) for i in order) for grid in ranges],
+                      is_complex_task)
+            self._put(key, result)
+        else:
+            self.hits += 1
+        status, ranges, is_complex_task = result
+        return status, [[[set(cell) for cell in grid[rank[i]]] for i in range(len(table))] for grid in ranges], \
+            is_complex_task
+
+    def _get(self, key):
+        if key in self.results:
+            self.results.move_to_end(key)
+            return self.results[key]
+        if self.store is not None:
+            result = self.store.get(hashlib.sha256(repr(key).encode()).hexdigest())
+            if result is not None:
+                self._put(key, result, store=False)
+            return result
+        return None
+
+    def _put(self, key, result, store=True):
+        self.results[key] = result
+        while len(self.results) > self.max_size:
+            self.results.popitem(last=False)
+        if store and self.store is not None:
+            self.store[hashlib.sha256(repr(key).encode()).hexdigest()] = result
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
+
+class SolverSession:
+    """Incremental solving of one grid while relations are added and taken back.
+
+    The session keeps the propagated bitset domains of its relations. `add_relation` revises the new
+    relation and then only the rows and relations it affects. Every change is recorded on a trail, so `pop`
+    takes back the relations added since the matching `push` without propagating again."""
+
+    def __init__(self, table: List[List[str]], relations=(), *,
+                 alldifferent: Literal['singles', 'matching'] = 'singles', stats: SolverStats = None):
+        self.table = table
+        self.propagator = Propagator([], len(table), stats, alldifferent)
+        self.domains = [[(1 << len(words)) - 1] * len(words) for words in table]
+        self.trail = []
+        self.checkpoints = []  # (trail mark, number of relations, consistent) of every `push`
+        self.consistent = self.propagator.propagate(self.domains, trail=self.trail)
+        for relation in relations:
+            self.add_relation(*relation)
+
+    def add_relation(self, ins: List[int], wns: List[str],
+                     callable_objects: Union[Callable, Set[Callable], List[Callable]], *other) -> bool:
+        """Add a relation given like the relations of `solve_puzzle` and propagate it, returns whether the grid
+        is still consistent. Once it is not, relations are only recorded until `pop`."""
+        for relation in compile_relations(self.table, _normalize_relations([(ins, wns, callable_objects, *other)]),
+                                          self.propagator.stats):
+            r = self.propagator.add_relation(relation)
+            if self.consistent:
+                # the row filters may leave an empty value or position without failing, like at the root of
+                # `solve_puzzle`
+                self.consistent = (self.propagator.propagate(self.domains, [], self.trail, [r])
+                                   and domains_status(self.domains) is not False)
+        return self.consistent
+
+    def push(self):
+        """Save a checkpoint that `pop` returns to."""
+        self.checkpoints.append((len(self.trail), len(self.propagator.relations), self.consistent))
+
+    def pop(self):
+        """Take back the relations and domain changes since the last `push`."""
+        if not self.checkpoints:
+            raise IndexError('pop without push')
+        mark, n_relations, self.consistent = self.checkpoints.pop()
+        undo(self.trail, mark)
+        while len(self.propagator.relations) > n_relations:
+            self.propagator.remove_last_relation()
+
+    def ranges(self) -> List[List[Set[str]]]:
+        """The current domains as ranges of words, like the ranges of `solve_puzzle`."""
+        return domains_to_ranges(self.table, self.domains)
+
+    def status(self) -> Union[bool, None]:
+        """True if propagation solved the grid, False if it found a contradiction, None if the grid needs a
+        search (see `count_solutions`)."""
+        return domains_status(self.domains) if self.consistent else False
+
+    def count_solutions(self, max_count: Union[int, None] = None, max_seconds: Union[float, None] = None,
+                        max_nodes: Union[int, None] = None) -> Union[int, None]:
+        """The number of solutions of the current grid, at most `max_count` if it is given, None if the budget
+        is exhausted (see `count_solutions`). The domains of the session are left unchanged."""
+        if max_count is not None and max_count <= 0:
+            return 0
+        if not self.consistent:
+            return 0
+        budget = Budget(max_seconds, max_nodes)
+        n_ways = count_domain_solutions(self.domains, self.propagator, max_count, budget)
+        return None if budget.exhausted else n_ways
+
+
 def solve_einstein_riddle():
     print("Einstein's Riddle")
     task = ' ' * 4 + """
@@ -193,11 +2039,11 @@ def solve_einstein_riddle():
     ]
     center = len(classified_objects[0]) // 2
     rules_for_relations = [
-        ({'neighbor', 'next'}, lambda c1, c2: c1 == c2 - 1 or c1 == c2 + 1),
-        ('first', lambda c1: c1 == 0),
-        ('center', lambda c1, center=center: c1 == center),
-        ('left', lambda c1, c2: c1 == c2 - 1),
-        ({'live', 'keep', 'drink', 'smoke'}, lambda c1, c2: c1 == c2),
+        ({'neighbor', 'next'}, Offset((-1, 1))),
+        ('first', At(frozenset({0}))),
+        ('center', At(frozenset({center}))),
+        ('left', Offset((-1,))),
+        ({'live', 'keep', 'drink', 'smoke'}, Same()),
     ]
 
     relations = list()
@@ -268,11 +2114,11 @@ def solve_zebra_puzzle():
     ]
     center = len(classified_objects[0]) // 2
     rules_for_relations = [
-        ('first', lambda c1: c1 == 0),
-        ('middle', lambda c1, center=center: c1 == center),
-        ('next', lambda c1, c2: c1 == c2 - 1 or c1 == c2 + 1),
-        ('right', lambda c1, c2: c1 == c2 + 1),
-        ({'live', 'own', 'drink', 'drunk', 'smoke'}, lambda c1, c2: c1 == c2),
+        ('first', At(frozenset({0}))),
+        ('middle', At(frozenset({center}))),
+        ('next', Offset((-1, 1))),
+        ('right', Offset((1,))),
+        ({'live', 'own', 'drink', 'drunk', 'smoke'}, Same()),
     ]
 
     relations = list()
@@ -352,14 +2198,14 @@ def solve_blood_donation_puzzle():
     task = task.replace('youngest', '25').replace('oldest', '45')
     end = len(classified_objects[0]) - 1
     rules_for_relations = [
-        ('next', lambda c1, c2: c1 == c2 - 1 or c1 == c2 + 1),
-        ('ends', lambda c1: c1 == 0 or c1 == end),
-        ('somewhere to the left', lambda c1, c2: c1 < c2),
-        ('somewhere to the right', lambda c1, c2: c1 > c2),
-        ('left', lambda c1, c2: c1 == c2 - 1),
-        ('right', lambda c1, c2: c1 == c2 + 1),
-        ('between', lambda c1, c2, c3: c2 < c1 < c3 or c3 < c1 < c2),
-        ({'is', 'weighs'}, lambda c1, c2: c1 == c2),
+        ('next', Offset((-1, 1))),
+        ('ends', At(frozenset({0, end}))),
+        ('somewhere to the left', Compare('<')),
+        ('somewhere to the right', Compare('>')),
+        ('left', Offset((-1,))),
+        ('right', Offset((1,))),
+        ('between', Between(adjacent=False)),
+        ({'is', 'weighs'}, Same()),
     ]
 
     relations = list()
@@ -0,0 +1,260 @@
+import os
+import sys
+import random
+import types
+import tempfile
+import unittest
+import unittest.mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import generator_example  # noqa: E402
+import solver_example  # noqa: E402
+
+
+def random_relations(seed, n_attributes, m_objects, n_relations, level=12):
+    """Random compiled relations from `rule_catalog`, so they hold for the answer of a generated grid, in
+    which the value index of every word is its column."""
+    rng = random.Random(seed)
+    catalog = generator_example.rule_catalog(level, m_objects)
+    relations = []
+    while len(relations) < n_relations:
+        n_args = rng.randint(1, 3)
+        ins = [rng.randrange(n_attributes) for _ in range(n_args)]
+        vns = [rng.randrange(m_objects) for _ in range(n_args)]
+        rules = [rule for rule in catalog.get(tuple(vns), ()) if not rule[2] or len(set(ins)) == n_args]
+        if rules:
+            relations.append((ins, vns, rng.choice(rules)[0]))
+    return relations
+
+
+def count_answers(relations, n_attributes, m_objects, max_count=None):
+    """The number of solutions of compiled generator relations, counted by the solver."""
+    table = [[f'{"abcdefgh"[i]}{j}' for j in range(m_objects)] for i in range(n_attributes)]
+    return solver_example.count_solutions(table, [(ins, [table[i][v] for i, v in zip(ins, vns)], kind)
+                                                  for ins, vns, kind, *_ in relations], max_count=max_count)
+
+
+def generated_relations(seed, n_attributes, m_objects, **options):
+    """The premises of a puzzle of `generate_puzzle` with `options` and its compiled relations, which it does not
+    return, as the relations of the portfolio or, if it is run, of the minimization."""
+    random.seed(seed)
+    table = [[f'K{i}'] + [f'{"abcdefgh"[i]}{j}' for j in range(m_objects)] for i in range(n_attributes)]
+    portfolio, minimize = generator_example.portfolio_relations, generator_example.minimize_relations
+    found = []
+
+    def portfolio_relations(*args):
+        found.append(portfolio(*args))
+        return found[-1]
+
+    def minimize_relations(*args):
+        relations, timed_out = minimize(*args)
+        found.append(relations)
+        return relations, timed_out
+
+    with unittest.mock.patch.object(generator_example, 'portfolio_relations', portfolio_relations), \
+            unittest.mock.patch.object(generator_example, 'minimize_relations', minimize_relations):
+        premises = generator_example.generate_puzzle(table, **options)
+    return premises, found[-1]
+
+
+class SharedEngineTest(unittest.TestCase):
+    def test_search_is_the_solver_one(self):
+        # check_unique branches like the solver, on the cell that `solver_example.select_cell` picks
+        for name in ('Propagator', 'Budget', 'backtrack', 'count_value_degrees', 'undo', 'RelationKind'):
+            with self.subTest(name=name):
+                self.assertIs(getattr(generator_example, name), getattr(solver_example, name))
+        self.assertFalse(hasattr(generator_example, 'select_cell'))
+
+
+class CheckUniqueTest(unittest.TestCase):
+    def test_random_relations(self):
+        for seed in range(200):
+            rng = random.Random(seed)
+            n_attributes, m_objects = rng.randint(1, 3), rng.randint(2, 4)
+            relations = random_relations(seed, n_attributes, m_objects, rng.randint(1, 8))
+            for alldifferent in ('singles', 'matching'):
+                with self.subTest(seed=seed, alldifferent=alldifferent):
+                    self.assertEqual(generator_example.check_unique(relations, n_attributes, m_objects, alldifferent),
+                                     count_answers(relations, n_attributes, m_objects, max_count=2) == 1)
+
+    def test_exhausted_budget_is_not_unique(self):
+        relations = random_relations(70, 3, 4, 12)  # unique, but only after a search
+        self.assertTrue(generator_example.check_unique(relations, 3, 4))
+        budget = solver_example.Budget(max_nodes=0)
+        self.assertFalse(generator_example.check_unique(relations, 3, 4, budget=budget))
+        self.assertTrue(budget.exhausted)
+
+
+class MinimizationTest(unittest.TestCase):
+    def assertMinimal(self, relations, n_attributes, m_objects):
+        self.assertEqual(count_answers(relations, n_attributes, m_objects, max_count=2), 1)
+        for k in range(len(relations)):
+            self.assertEqual(count_answers(relations[:k] + relations[k + 1:], n_attributes, m_objects, max_count=2), 2)
+
+    def test_minimize_relations(self):
+        for seed in range(30):
+            relations = random_relations(seed, 3, 4, 32)
+            if not generator_example.check_unique(relations, 3, 4):
+                continue
+            for one_by_one in (False, True):
+                with self.subTest(seed=seed, one_by_one=one_by_one):
+                    minimal, timed_out = generator_example.minimize_relations(
+                        relations, lambda rest: generator_example.check_unique(rest, 3, 4), one_by_one=one_by_one)
+                    self.assertFalse(timed_out)
+                    # relations are only removed, the rest keep their order
+                    rest = iter(relations)
+                    self.assertTrue(all(relation in rest for relation in minimal))
+                    self.assertMinimal(minimal, 3, 4)
+
+    def test_generate_puzzle(self):
+        for seed, (n_attributes, m_objects, level) in enumerate([(2, 3, 1), (3, 4, 5), (3, 4, 12), (4, 4, 20)]):
+            for minimization in ('chunks', 'one_by_one'):
+                with self.subTest(seed=seed, level=level, minimization=minimization):
+                    premises, relations = generated_relations(seed, n_attributes, m_objects, level=level,
+                                                              minimal_conditions=True, minimization=minimization)
+                    self.assertEqual(sorted(premises), sorted(relation[-1] for relation in relations))
+                    self.assertMinimal(relations, n_attributes, m_objects)
+
+    def test_lookahead(self):
+        for seed, (n_attributes, m_objects, level) in enumerate([(2, 3, 1), (3, 4, 5), (3, 4, 12), (4, 4, 20)]):
+            for lookahead in (1, 8):
+                with self.subTest(seed=seed, level=level, lookahead=lookahead):
+                    _, relations = generated_relations(seed, n_attributes, m_objects, level=level,
+                                                       minimal_conditions=True, lookahead=lookahead)
+                    self.assertMinimal(relations, n_attributes, m_objects)
+
+
+class LookaheadTest(unittest.TestCase):
+    def test_build_relations(self):
+        table = [[f'K{i}'] + [f'{"abcd"[i]}{j}' for j in range(4)] for i in range(4)]
+        for level in (1, 5, 12, 20):
+            for lookahead in (1, 4, 16):
+                with self.subTest(level=level, lookahead=lookahead):
+                    relations = generator_example.build_relations(table, level, rng=random.Random(level),
+                                                                  lookahead=lookahead)
+                    self.assertEqual(count_answers(relations, 4, 4, max_count=2), 1)
+                    # the trials leave no trace, so the same seed gives the same relations
+                    self.assertEqual(generator_example.build_relations(table, level, rng=random.Random(level),
+                                                                       lookahead=lookahead), relations)
+
+    def test_fewer_relations(self):
+        table = [[f'K{i}'] + [f'{"abcd"[i]}{j}' for j in range(4)] for i in range(4)]
+        for level in (1, 5, 12, 20):
+            with self.subTest(level=level):
+                n_relations = [sum(len(generator_example.build_relations(table, level, rng=random.Random(seed),
+                                                                         lookahead=lookahead)) for seed in range(20))
+                               for lookahead in (0, 8)]
+                self.assertLess(n_relations[1], n_relations[0])
+
+
+class UniquenessPoolTest(unittest.TestCase):
+    def test_first_unique(self):
+        pool = generator_example.UniquenessPool(2, 3, 4)
+        try:
+            for seed in range(20):
+                relations = random_relations(seed, 3, 4, 24)
+                # the first unique prefix is far from the start, the first unique removal of a chunk is near it
+                for chunk in (None, 1, 4):
+                    candidates = [relations[:start] + relations[start + chunk:]
+                                  for start in range(0, len(relations), chunk)] if chunk else [
+                        relations[:k] for k in range(len(relations) + 1)]
+                    with self.subTest(seed=seed, chunk=chunk):
+                        expected = generator_example.first_unique(
+                            candidates, lambda rest: generator_example.check_unique(rest, 3, 4))
+                        self.assertEqual(pool.first_unique(candidates), expected)
+                        self.assertEqual(pool.first_unique(iter(candidates)), expected)
+        finally:
+            pool.close()
+
+    def test_generate_puzzle(self):
+        for workers in (2, 3):
+            with self.subTest(workers=workers):
+                self.assertEqual(generated_relations(0, 3, 4, level=5, minimal_conditions=True, workers=workers),
+                                 generated_relations(0, 3, 4, level=5, minimal_conditions=True))
+
+
+class PortfolioTest(unittest.TestCase):
+    table = [[f'K{i}'] + [f'{"abcd"[i]}{j}' for j in range(4)] for i in range(4)]
+
+    def test_best_try(self):
+        for level in (1, 12, 20):
+            rng = random.Random(level)
+            seeds = [rng.getrandbits(64) for _ in range(6)]
+            tries = [generator_example.build_relations(self.table, level, rng=random.Random(seed)) for seed in seeds]
+            # the fewest relations, the first try among equals
+            expected = min(tries, key=len)
+            for workers in (1, 3):
+                with self.subTest(level=level, workers=workers):
+                    relations = generator_example.portfolio_relations(self.table, level, 'singles', seeds, workers)
+                    self.assertEqual(relations, expected)
+                    self.assertTrue(generator_example.check_unique(relations, 4, 4))
+
+
+class GenerateBatchTest(unittest.TestCase):
+    def generate(self, out_dir, stop_after=None):
+        """`generate_batch` into `out_dir`, interrupted like by Ctrl+C before the puzzle after `stop_after`
+        is written."""
+        format_puzzle = generator_example.format_puzzle
+        n_written = 0
+
+        def interrupted_format_puzzle(*args):
+            nonlocal n_written
+            n_written += 1
+            if stop_after is not None and n_written > stop_after:
+                raise KeyboardInterrupt
+            return format_puzzle(*args)
+
+        with unittest.mock.patch.object(generator_example, 'format_puzzle', interrupted_format_puzzle):
+            try:
+                generator_example.generate_batch(out_dir, [2, 3], [3], [1, 2], range(3), workers=2, flush_every=2,
+                                                 jsonl=True)
+            except KeyboardInterrupt:
+                pass
+
+    @staticmethod
+    def read(out_dir):
+        files = {}
+        for name in os.listdir(out_dir):
+            if not name.startswith('checkpoint.'):
+                with open(os.path.join(out_dir, name)) as file:
+                    files[name] = file.read()
+        return files
+
+    def test_resume(self):
+        with tempfile.TemporaryDirectory() as expected_dir, tempfile.TemporaryDirectory() as out_dir:
+            self.generate(expected_dir)
+            # after a checkpoint, between checkpoints and in the next file
+            for stop_after in (4, 1, 3):
+                self.generate(out_dir, stop_after)
+            self.generate(out_dir)
+            expected = self.read(expected_dir)
+            self.assertEqual(sorted(expected), ['2x3.0of1.jsonl', '2x3.0of1.txt', '3x3.0of1.jsonl', '3x3.0of1.txt'])
+            self.assertEqual(self.read(out_dir), expected)
+
+
+class RuleCatalogTest(unittest.TestCase):
+    def test_read_only_and_cached(self):
+        catalog = generator_example.rule_catalog(12, 4)
+        self.assertIsInstance(catalog, types.MappingProxyType)
+        self.assertIs(generator_example.rule_catalog(12, 4), catalog)
+        with self.assertRaises(TypeError):
+            catalog[0,] = ()
+        with self.assertRaises((TypeError, AttributeError)):
+            catalog[0,].append(catalog[1,][0])
+
+    def test_rules_hold_for_their_positions(self):
+        for level in range(1, 20 + 1):
+            for m_objects in range(3 if level >= 19 else 2, 6):
+                with self.subTest(level=level, m_objects=m_objects):
+                    catalog = generator_example.rule_catalog(level, m_objects)
+                    self.assertTrue(catalog)
+                    for positions, rules in catalog.items():
+                        for kind, str_variants, _ in rules:
+                            self.assertEqual(len(positions), kind.n_args)
+                            self.assertTrue(kind(*positions))
+                            self.assertTrue(all(f'{{{2 * len(positions) - 1}}}' in text for text in str_variants))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,291 @@
+import os
+import sys
+import random
+import dataclasses
+import itertools
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import solver_example  # noqa: E402
+
+
+KINDS = [(1, lambda a: a == 0), (1, lambda a: a % 2 == 1), (2, lambda a, b: a == b),
+         (2, lambda a, b: a - b == 1), (2, lambda a, b: a < b), (2, lambda a, b: abs(a - b) == 1),
+         (3, lambda a, b, c: b < a < c or c < a < b)]
+
+
+def random_puzzle(seed, max_relations=6):
+    """A small random (table, relations) puzzle, often with several solutions or none."""
+    rng = random.Random(seed)
+    n_rows = rng.randint(1, 3)
+    m_objects = rng.randint(2, 3 if n_rows == 3 else 4)
+    table = [[f'{"abc"[i]}{k}' for k in range(m_objects)] for i in range(n_rows)]
+    relations = []
+    for _ in range(rng.randint(1, max_relations)):
+        n_args, f = rng.choice(KINDS)
+        ins = [rng.randrange(n_rows) for _ in range(n_args)]
+        relations.append((ins, [rng.choice(table[i]) for i in ins], f))
+    return table, relations
+
+
+def brute_force_solutions(table, relations):
+    """Every solution of a small puzzle, found over every permutation of every row, as the word at every
+    position of every row."""
+    m_objects = len(table[0])
+    solutions = []
+    for perms in itertools.product(itertools.permutations(range(m_objects)), repeat=len(table)):
+        positions = [dict(zip(words, perm)) for words, perm in zip(table, perms)]
+        if all(f(*(positions[i][v] for i, v in zip(ins, vns))) for ins, vns, f in relations):
+            solutions.append(tuple(tuple(sorted(words, key=row.get)) for words, row in zip(table, positions)))
+    return solutions
+
+
+def brute_force(table, relations):
+    """Number of solutions of a small puzzle."""
+    return len(brute_force_solutions(table, relations))
+
+
+def solution_words(ranges):
+    """The word at every position of every row of solved ranges."""
+    return tuple(tuple(next(iter(cell)) for cell in row) for row in ranges)
+
+
+class RelationKindTest(unittest.TestCase):
+    def test_kind_without_supports_fails_when_created(self):
+        @dataclasses.dataclass(frozen=True)
+        class Anywhere(solver_example.RelationKind):
+            n_args = 1
+
+            def __call__(self, c1):
+                return True
+        with self.assertRaises(TypeError):
+            Anywhere()
+
+
+class ContradictionTest(unittest.TestCase):
+    table = [['a', 'b']]
+    relations = [([0], ['a'], lambda c: c == 0), ([0], ['b'], lambda c: c == 0)]
+
+    def test_engines(self):
+        for options in ({}, {'engine': 'sets'}, {'engine': 'dlx'}, {'search': 'dfs'}, {'workers': 2}):
+            with self.subTest(**options):
+                status, _, is_complex = solver_example.solve_puzzle(self.table, self.relations, **options)
+                self.assertIs(status, False)
+                self.assertFalse(is_complex)
+
+    def test_solve_puzzles(self):
+        (status, _, _), = solver_example.solve_puzzles([(self.table, self.relations)], vectorized=False)
+        self.assertIs(status, False)
+
+
+class ParallelBudgetTest(unittest.TestCase):
+    def test_max_nodes_is_shared_by_workers(self):
+        table = [[f'{row}{k}' for k in range(5)] for row in 'abc']
+        relations = [([0, 1], ['a0', 'b0'], lambda c1, c2: c1 == c2)]
+        stats = solver_example.SolverStats()
+        status, _, is_complex = solver_example.solve_puzzle(table, relations, workers=3, max_nodes=300,
+                                                            search='dfs', stats=stats)
+        self.assertIsNone(status)
+        self.assertTrue(is_complex)
+        # only the node that went over the limit is counted, later ones are not started
+        self.assertLessEqual(stats.nodes, 301)
+
+
+POSITION = 0  # read by the relations of TruthTableTest and SolveCacheTest
+
+
+class TruthTableTest(unittest.TestCase):
+    def test_global_values_are_part_of_the_key(self):
+        global POSITION
+
+        def relation(c):
+            return c == POSITION
+        first = solver_example.truth_table(relation, 1, 3)
+        POSITION = 2
+        try:
+            second = solver_example.truth_table(relation, 1, 3)
+        finally:
+            POSITION = 0
+        self.assertEqual((first, second), (0b001, 0b100))
+
+
+class SolveCacheTest(unittest.TestCase):
+    def test_global_values_are_part_of_the_key(self):
+        global POSITION
+        cache = solver_example.SolveCache(16)
+        table = [['a', 'b']]
+        first = cache.solve(table, [([0], ['a'], lambda c: c == POSITION)])
+        POSITION = 1
+        try:
+            second = cache.solve(table, [([0], ['a'], lambda c: c == POSITION)])
+        finally:
+            POSITION = 0
+        self.assertEqual(first[1], [[[{'a'}, {'b'}]]])
+        self.assertEqual(second[1], [[[{'b'}, {'a'}]]])
+
+
+    def test_options_are_part_of_the_key(self):
+        cache = solver_example.SolveCache(16)
+        table = [['a0', 'a1', 'a2', 'a3'], ['b0', 'b1', 'b2']]
+        relations = [([0], ['a0'], lambda c: c < 2), ([0], ['a1'], lambda c: c < 2)]
+        for options in ({}, {'allow_complex': False}, {'allow_complex': False, 'alldifferent': 'matching'},
+                        {'max_solutions': 1}, {'max_solutions': 1, 'workers': 2}, {'workers': 2},
+                        {'engine': 'sets'}, {'engine': 'dlx'}, {'search': 'dfs'}):
+            with self.subTest(**options):
+                self.assertEqual(cache.solve(table, relations, **options),
+                                 solver_example.solve_puzzle(table, relations, **options))
+
+
+class BruteForceTest(unittest.TestCase):
+    def test_random_puzzles(self):
+        for seed in range(100):
+            table, relations = random_puzzle(seed)
+            n_solutions = brute_force(table, relations)
+            for options in ({}, {'engine': 'dlx'}, {'search': 'dfs'}):
+                with self.subTest(seed=seed, **options):
+                    status, solutions, is_complex = solver_example.solve_puzzle(table, relations, **options)
+                    if not n_solutions:
+                        self.assertTrue(status is False or is_complex and not solutions)
+                    else:
+                        self.assertTrue(status)
+                        self.assertEqual(len(solutions) if is_complex else 1, n_solutions)
+
+
+    def test_iter_solutions(self):
+        for seed in range(100):
+            table, relations = random_puzzle(seed)
+            expected = sorted(brute_force_solutions(table, relations))
+            for search in ('bfs', 'dfs'):
+                with self.subTest(seed=seed, search=search):
+                    found = [solution_words(ranges)
+                             for ranges in solver_example.iter_solutions(table, relations, search=search)]
+                    self.assertEqual(len(found), len(set(found)))
+                    self.assertEqual(sorted(found), expected)
+
+    def test_count_solutions(self):
+        for seed in range(100):
+            table, relations = random_puzzle(seed)
+            n_solutions = brute_force(table, relations)
+            for max_count in (None, 1, 2, 5):
+                with self.subTest(seed=seed, max_count=max_count):
+                    expected = n_solutions if max_count is None else min(n_solutions, max_count)
+                    self.assertEqual(solver_example.count_solutions(table, relations, max_count=max_count), expected)
+
+    def test_nogoods(self):
+        for seed in range(100):
+            table, relations = random_puzzle(seed)
+            expected = sorted(brute_force_solutions(table, relations))
+            for max_nogoods in (1, 16):
+                with self.subTest(seed=seed, max_nogoods=max_nogoods):
+                    found = [solution_words(ranges) for ranges in
+                             solver_example.iter_solutions(table, relations, search='dfs', max_nogoods=max_nogoods)]
+                    self.assertEqual(sorted(found), expected)
+                    status, _, _ = solver_example.solve_puzzle(table, relations, search='dfs',
+                                                               max_nogoods=max_nogoods)
+                    self.assertEqual(bool(status), bool(expected))
+
+    def test_update_row_matching(self):
+        rng = random.Random(0)
+        for k in range(300):
+            n = rng.randint(1, 5)
+            row = [rng.randrange(1 << n) for _ in range(n)]
+            # a position stays in a mask if some perfect matching of values to positions uses it
+            expected = [0] * n
+            for perm in itertools.permutations(range(n)):
+                if all(row[v] >> p & 1 for v, p in enumerate(perm)):
+                    for v, p in enumerate(perm):
+                        expected[v] |= 1 << p
+            with self.subTest(row=row):
+                filtered = row.copy()
+                solver_example.update_row_matching(filtered)
+                if any(expected):
+                    self.assertEqual(filtered, expected)
+                else:
+                    self.assertIn(0, filtered)
+
+    def test_matching(self):
+        for seed in range(100):
+            table, relations = random_puzzle(seed)
+            expected = sorted(brute_force_solutions(table, relations))
+            for search in ('bfs', 'dfs'):
+                with self.subTest(seed=seed, search=search):
+                    found = [solution_words(ranges) for ranges in
+                             solver_example.iter_solutions(table, relations, search=search, alldifferent='matching')]
+                    self.assertEqual(sorted(found), expected)
+                    self.assertEqual(solver_example.count_solutions(table, relations, alldifferent='matching'),
+                                     len(expected))
+
+    def test_dlx(self):
+        for seed in range(100):
+            table, relations = random_puzzle(seed)
+            expected = sorted(brute_force_solutions(table, relations))
+            with self.subTest(seed=seed):
+                propagator = solver_example.Propagator(solver_example.compile_relations(table, relations), len(table))
+                domains = [[(1 << len(words)) - 1] * len(words) for words in table]
+                found = []
+                if propagator.propagate(domains):
+                    # every exact cover is yielded once, without the de-duplication of `search_solutions`
+                    found = [solution_words(solver_example.domains_to_ranges(table, solved))
+                             for solved in solver_example.dancing_links(domains, propagator)]
+                self.assertEqual(len(found), len(set(found)))
+                self.assertEqual(sorted(found), expected)
+                status, solutions, _ = solver_example.solve_puzzle(table, relations, engine='dlx')
+                if expected:
+                    self.assertEqual(sorted(map(solution_words, solutions)), expected)
+                else:
+                    self.assertIs(status, False)
+
+    def test_session(self):
+        for seed in range(100):
+            table, relations = random_puzzle(seed)
+            session = solver_example.SolverSession(table)
+            counts = [brute_force(table, relations[:k]) for k in range(len(relations) + 1)]
+            ranges = [solver_example.SolverSession(table, relations[:k]).ranges() for k in range(len(relations) + 1)]
+            for k, relation in enumerate(relations, 1):
+                session.push()
+                with self.subTest(seed=seed, relations=k):
+                    consistent = session.add_relation(*relation)
+                    self.assertEqual(consistent, session.status() is not False)
+                    self.assertTrue(consistent or not counts[k])
+                    self.assertEqual(session.count_solutions(), counts[k])
+                    if counts[k]:
+                        self.assertEqual(session.ranges(), ranges[k])
+            for k in range(len(relations) - 1, -1, -1):
+                session.pop()
+                with self.subTest(seed=seed, popped_to=k):
+                    self.assertEqual(session.count_solutions(), counts[k])
+                    self.assertEqual(session.ranges(), ranges[k])
+            with self.assertRaises(IndexError):
+                session.pop()
+
+    @unittest.skipIf(solver_example.numpy is None, 'needs numpy')
+    def test_propagate_batch(self):
+        shapes = {}
+        for seed in range(300):
+            table, relations = random_puzzle(seed, max_relations=8)
+            if brute_force(table, relations):
+                shapes.setdefault((len(table), len(table[0])), []).append((seed, table, relations))
+        for puzzles in shapes.values():
+            batch = solver_example.propagate_batch([table for _, table, _ in puzzles],
+                                                   [solver_example._normalize_relations(relations)
+                                                    for _, _, relations in puzzles])
+            for (seed, table, relations), domains in zip(puzzles, batch):
+                with self.subTest(seed=seed):
+                    expected = [[(1 << len(words)) - 1] * len(words) for words in table]
+                    propagator = solver_example.Propagator(solver_example.compile_relations(table, relations),
+                                                           len(table))
+                    self.assertTrue(propagator.propagate(expected))
+                    self.assertEqual(domains, expected)
+
+    @unittest.skipIf(solver_example.numpy is None, 'needs numpy')
+    def test_solve_puzzles_vectorized(self):
+        puzzles = [random_puzzle(seed, max_relations=8) for seed in range(200)]
+        batch_results = solver_example.solve_puzzles(puzzles, vectorized=True)
+        for seed, ((table, relations), result) in enumerate(zip(puzzles, batch_results)):
+            with self.subTest(seed=seed):
+                self.assertEqual(result, solver_example.solve_puzzle(table, relations))
+
+
+if __name__ == '__main__':
+    unittest.main()